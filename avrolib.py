@@ -1,29 +1,202 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, deque, namedtuple
+from html.entities import html5
+from functools import lru_cache
+from itertools import chain, islice, product
+from types import MappingProxyType
+import random
+import re
+import threading
+import time
+
+
 class AvroParser():
     def __init__(self):
-        self.init_data()
+        # Parsers of a class share the data init_data gives and the tables
+        # compiled from it, which _use_data freezes so that no parser can
+        # change them under the others
+        prototype = self._prototypes.get(type(self))
+        if prototype is None:
+            prototype = type(self).__new__(type(self))
+            prototype.init_data()
+            prototype._use_data()
+            prototype._candidates()
+            self._prototypes[type(self)] = prototype
+        self.__dict__.update(prototype.__dict__)
+
+    # Parsers holding the compiled init_data of each class
+    _prototypes = {}
+
+    @classmethod
+    def _frozen(cls, value):
+        """Returns value with every dict in it made a read-only view and
+        every list a tuple, keeping the views and tuples it already has"""
+        if isinstance(value, dict):
+            return MappingProxyType(dict((key, cls._frozen(item))
+                                         for key, item in value.items()))
+        if isinstance(value, list):
+            return tuple([cls._frozen(item) for item in value])
+        return value
+
+    @classmethod
+    def _thawed(cls, value):
+        """Returns a copy of frozen value made of dicts and lists again"""
+        if isinstance(value, MappingProxyType):
+            return dict((key, cls._thawed(item)) for key, item in value.items())
+        if isinstance(value, tuple):
+            return [cls._thawed(item) for item in value]
+        return value
+
+    def _use_data(self):
+        self.data = self._frozen(self.data)
         self.PATTERNS = self.data['PATTERNS']
-        self.NON_RULE_PATTERNS = [p for p in self.PATTERNS if 'rules' not in p]
-        self.RULE_PATTERNS = [p for p in self.PATTERNS if 'rules' in p]
+        self.NON_RULE_PATTERNS = tuple(p for p in self.PATTERNS if 'rules' not in p)
+        self.RULE_PATTERNS = tuple(p for p in self.PATTERNS if 'rules' in p)
 
         self.VOWELS = self.data['VOWELS']
         self.CONSONANTS = self.data['CONSONANTS']
         self.CASESENSITIVES = self.data['CASESENSITIVES']
         self.DIGITS = self.data['DIGITS']
 
+    # Compiled parsers made by from_ruleset, by content hash, oldest first
+    _rulesets = {}
+    RULESET_CACHE_SIZE = 16
+
+    @classmethod
+    def from_ruleset(cls, ruleset):
+        """Returns a parser for a ruleset given as a dict, or as the path
+        of a JSON file, in the schema of init_data
+
+        The ruleset is validated and compiled into the tables the engine
+        matches with. Compiled parsers are cached by a hash of the
+        ruleset's content, so loading the same ruleset again costs only
+        the hash, and rules of patterns that also appear in other loaded
+        rulesets are not analysed again. DIGITS may be left out. Raises
+        ValueError naming the first entry that is not valid.
+
+        Parsers of the same ruleset, like every AvroParser() of a class,
+        share its data, which is therefore read-only: data and PATTERNS
+        hold tuples and read-only mappings, and changing them raises
+        TypeError. Changed rulesets are made with from_ruleset or overlay.
+
+        Usage:
+
+        ::
+        from avrolib import AvroParser
+        avro = AvroParser.from_ruleset('rules.json')
+        avro.parse("ami banglay gan gai")
+
+        """
+        import hashlib
+        import json
+        if not isinstance(ruleset, dict):
+            with open(ruleset, encoding='utf-8') as source:
+                ruleset = json.load(source)
+        canonical = json.dumps(ruleset, ensure_ascii=False, sort_keys=True)
+        key = (cls, hashlib.sha256(canonical.encode('utf-8')).hexdigest())
+        compiled = cls._rulesets.get(key)
+        if compiled is None:
+            data = json.loads(canonical)
+            cls._validate_ruleset(data)
+            data.setdefault('DIGITS', '')
+            compiled = cls.__new__(cls)
+            compiled.data = data
+            compiled._use_data()
+            # The content hash names the ruleset for the pruning cache too
+            compiled._ruleset_key = key[1]
+            compiled._candidates()
+            cls._rulesets[key] = compiled
+            if len(cls._rulesets) > cls.RULESET_CACHE_SIZE:
+                del cls._rulesets[next(iter(cls._rulesets))]
+        # Parsers share the compiled tables, which are never changed
+        parser = cls.__new__(cls)
+        parser.__dict__.update(compiled.__dict__)
+        return parser
+
+    SCOPES = ('vowel', 'consonant', 'punctuation', 'exact')
+
+    @classmethod
+    def _validate_ruleset(cls, data):
+        """Raises ValueError if data is not a ruleset parse can use"""
+        def check(ok, where, problem):
+            if not ok:
+                raise ValueError('%s: %s' % (where, problem))
+        check(isinstance(data, dict), 'ruleset', 'must be an object')
+        for name in ('VOWELS', 'CONSONANTS', 'CASESENSITIVES', 'DIGITS'):
+            check(isinstance(data.get(name, ''), str), name, 'must be a string')
+            check(name == 'DIGITS' or name in data, name, 'is missing')
+        patterns = data.get('PATTERNS')
+        check(isinstance(patterns, list) and patterns, 'PATTERNS',
+              'must be a non-empty list')
+        for index, pattern in enumerate(patterns):
+            where = 'PATTERNS[%d]' % index
+            check(isinstance(pattern, dict), where, 'must be an object')
+            check(isinstance(pattern.get('find'), str) and pattern['find'],
+                  where + '.find', 'must be a non-empty string')
+            check(isinstance(pattern.get('replace'), str), where + '.replace',
+                  'must be a string')
+            if 'rules' not in pattern:
+                continue
+            check(isinstance(pattern['rules'], list), where + '.rules', 'must be a list')
+            for number, rule in enumerate(pattern['rules']):
+                at = '%s.rules[%d]' % (where, number)
+                check(isinstance(rule, dict), at, 'must be an object')
+                check(isinstance(rule.get('replace'), str), at + '.replace',
+                      'must be a string')
+                check(isinstance(rule.get('matches'), list), at + '.matches',
+                      'must be a list')
+                for position, match in enumerate(rule['matches']):
+                    on = '%s.matches[%d]' % (at, position)
+                    check(isinstance(match, dict), on, 'must be an object')
+                    check(match.get('type') in ('prefix', 'suffix'), on + '.type',
+                          'must be prefix or suffix')
+                    check(isinstance(match.get('scope'), str) and
+                          match['scope'].lstrip('!') in cls.SCOPES, on + '.scope',
+                          'must be one of %s, optionally after !' % ', '.join(cls.SCOPES))
+                    if match['scope'].endswith('exact'):
+                        check(isinstance(match.get('value'), str) and match['value'],
+                              on + '.value', 'must be a non-empty string')
+
     def __del__(self):
         del self.data
 
+    def __getstate__(self):
+        # Profiling and metrics wrappers are closures and stay in this
+        # process, and tables keyed by id are rebuilt where they are needed
+        state = dict(self.__dict__)
+        for name in self._PROFILED + AvroMetrics._OBSERVED + (
+                '_profile', '_pruned', '_pattern_indexes', '_overlays', '_bytes',
+                'PATTERNS', 'NON_RULE_PATTERNS', 'RULE_PATTERNS'):
+            state.pop(name, None)
+        # Read-only views do not pickle, and the data is frozen again
+        state['data'] = self._thawed(self.data)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._use_data()
+
     @classmethod
     def parse_text(cls, text):
         AvroParser = cls()
         return AvroParser.parse(text)
 
-    def parse(self, text):
+    def parse(self, text, with_spans=False, with_tokens=False):
         """Parses input text, matches and replaces using avro library
 
         If a valid replacement is found, returns the replaced string. If
         no replacement is found, returns the input text.
 
+        If with_spans is True, returns a tuple of the output and an
+        AvroSpans aligning each consumed input span with its output span.
+
+        If with_tokens is True, the output is followed in the returned tuple
+        (after the spans, if also asked for) by a list of word tokens, each a
+        (source_start, source_end, output_start, output_end) tuple. Words are
+        runs of spans that begin with a character that is not punctuation.
+        Spans with empty output, such as "`", neither start nor end a word.
+
         Usage:
 
         ::
@@ -32,110 +205,1163 @@ class AvroParser():
         avro.parse("ami banglay gan gai")
 
         """
+        if with_spans or with_tokens:
+            return self._parse_aligned(text, with_spans, with_tokens)
         # Sanitize text case to meet phonetic comparison standards
+        return self._parse_fixed(self._fix_string_case(self._utf(text)))
+
+    def _parse_fixed(self, fixed_text):
+        """Parses text whose case has already been fixed"""
+        # Produce output from the replacement of every consumed span
+        return ''.join([span[2] for span in self._scan(fixed_text)])
+
+    def canonical(self, text):
+        """Returns a key of text that parses to the same output
+
+        Inputs that differ only in the case of letters that are not case
+        sensitive, or in the length of runs of characters the ruleset
+        drops, such as "`", past what any pattern or rule can tell apart,
+        share a key. The key is case fixed, so _parse_fixed(canonical(text)) is
+        parse(text). Whitespace and other characters that reach the output
+        are kept as they are.
+        """
+        try:
+            lower, silent, limits = self._canonical
+        except AttributeError:
+            lower, silent, limits = self._canonical = self._canonicalising()
+        text = self._utf(text)
+        if text.isascii():
+            text = text.translate(lower)
+        else:
+            text = self._fix_string_case(text)
+        if silent is not None:
+            text = silent.sub(lambda run: run.group()[:limits[run.group()[0]]], text)
+        return text
+
+    def _canonicalising(self):
+        """Returns the ASCII case fixing table, a regular expression of
+        overlong runs of dropped characters, and the length they are cut to"""
+        lower = dict((ord(char), char.lower()) for char in
+                     'ABCDEFGHIJKLMNOPQRSTUVWXYZ' if not self._is_case_sensitive(char))
+        # A character is dropped if the first pattern finding it alone
+        # replaces it with nothing whatever its context
+        first = {}
+        for pattern in self.NON_RULE_PATTERNS + self.RULE_PATTERNS:
+            first.setdefault(pattern['find'], pattern)
+        dropped = [find for find, pattern in first.items() if len(find) == 1 and
+                   not pattern['replace'] and not pattern.get('rules')]
+        # A find of nothing but a dropped character, such as "aa", consumes a
+        # run in steps, so where the steps end depends on the run's length
+        texts = [pattern['find'] for pattern in self.PATTERNS]
+        dropped = [char for char in dropped
+                   if not any(len(find) > 1 and not find.strip(char) for find in texts)]
+        if not dropped:
+            return lower, None, {}
+        # The rest are consumed one at a time, except for up to the longest
+        # run in a find or an exact match value at each end of a run. Runs
+        # longer than both ends and one more look the same to every pattern
+        # and rule around them
+        texts.extend(match.get('value', '') for pattern in self.PATTERNS
+                     for rule in pattern.get('rules', ()) for match in rule['matches'])
+        limits = {}
+        for char in dropped:
+            runs = re.compile('%s+' % re.escape(char))
+            limits[char] = 1 + 2 * max([len(run) for text in texts for run in runs.findall(text)])
+        silent = re.compile('|'.join('%s{%d,}' % (re.escape(char), limits[char] + 1)
+                                     for char in dropped))
+        return lower, silent, limits
+
+    Analysis = namedtuple('Analysis', ['unmatchable', 'shadowed', 'unreachable_rules',
+                                       'redundant_clauses', 'unanalysed', 'max_find',
+                                       'context'])
+
+    def analyse(self):
+        """Finds patterns, rules and rule matches that can never make a
+        difference to the output
+
+        Patterns are tried in order, non rule patterns before rule
+        patterns, and the first whose find matches wins. Within a pattern
+        the first rule whose matches all hold wins. Returns an Analysis of:
+
+        - "unmatchable": indexes into self.PATTERNS of patterns whose find
+          is changed by case fixing, so never appears in fixed text
+        - "shadowed": (index, by) pairs of patterns that only match where
+          the earlier pattern by, whose find begins theirs, matches too
+        - "unreachable_rules": (index, rule, by) tuples of rules of pattern
+          index that can only hold where earlier rules, listed in by, hold
+          too, or that never hold if by is empty
+        - "redundant_clauses": (index, rule, match) tuples of rule matches
+          that the other matches of their rule imply, and can be dropped
+          together
+        - "unanalysed": indexes of rule patterns whose analysis would check
+          rule matches against contexts more than RULE_CHECKS times, and
+          was skipped, so all their rules are kept
+        - "max_find": the length of the longest find
+        - "context": the (left, right) reach of _reach
+
+        Rule matches are checked against every context of the characters
+        they can read, with characters standing in for all others that no
+        exact match names and that class as the same kind of letter.
+
+        The engine leaves unmatchable and shadowed patterns and unreachable
+        rules out of the table it matches with.
+
+        """
+        findings = self._findings(self.PATTERNS)
+        return self.Analysis(*findings + (max(len(p['find']) for p in self.PATTERNS),
+                                          self._reach()))
+
+    def _findings(self, patterns):
+        """Returns the unmatchable, shadowed, unreachable_rules,
+        redundant_clauses and unanalysed of analyse for patterns, as
+        positions in patterns
+
+        Patterns only shadow patterns that begin with the same character,
+        so patterns may be every pattern of the ruleset beginning with some
+        set of characters, in ruleset order.
+
+        """
+        fix = type(self)._fix_string_case.__get__(self)
+        unmatchable = [position for position, pattern in enumerate(patterns)
+                       if fix(pattern['find']) != pattern['find']]
+        shadowed = []
+        # The first pattern that can win with each find. Rule patterns are
+        # only tried once every non rule pattern has failed
+        earlier = {}
+        for rules in (False, True):
+            for position, pattern in enumerate(patterns):
+                if ('rules' in pattern) != rules:
+                    continue
+                find = pattern['find']
+                by = [earlier[find[:end]] for end in range(1, len(find) + 1)
+                      if find[:end] in earlier]
+                if by:
+                    shadowed.append((position, min(
+                        by, key=lambda p: ('rules' in patterns[p], p))))
+                elif position not in unmatchable:
+                    earlier[find] = position
+        shadowed.sort()
+
+        unreachable_rules = []
+        redundant_clauses = []
+        unanalysed = []
+        for position, pattern in enumerate(patterns):
+            if 'rules' not in pattern:
+                continue
+            # Patterns unchanged since another ruleset are not analysed again
+            key = (self.VOWELS, self.CONSONANTS, self.CASESENSITIVES, repr(pattern))
+            try:
+                found = self._rule_analyses[key]
+            except KeyError:
+                found = self._rule_analyses[key] = self._analyse_rules(pattern)
+                if len(self._rule_analyses) > self.ANALYSIS_CACHE_SIZE:
+                    del self._rule_analyses[next(iter(self._rule_analyses))]
+            if found is None:
+                unanalysed.append(position)
+                continue
+            unreachable, redundant = found
+            unreachable_rules.extend((position,) + found for found in unreachable)
+            redundant_clauses.extend((position,) + found for found in redundant)
+        return unmatchable, shadowed, unreachable_rules, redundant_clauses, unanalysed
+
+    # Findings of _analyse_rules, by character classes and pattern, oldest
+    # first
+    _rule_analyses = {}
+    ANALYSIS_CACHE_SIZE = 1024
+
+    # Most checks of a rule match against a context made analysing the
+    # rules of one pattern
+    RULE_CHECKS = 1 << 18
+
+    def _analyse_rules(self, pattern):
+        """Returns the unreachable rules of pattern as (rule, by) pairs and
+        its redundant matches as (rule, match) pairs, as analyse does, or
+        None if its rules tell too many contexts apart to check them all"""
+        contexts = self._rule_contexts(pattern)
+        if contexts is None:
+            return None
+        unreachable = []
+        redundant = []
+        holds = []
+        for number, rule in enumerate(pattern['rules']):
+            sides = {}
+            for kind in ('prefix', 'suffix'):
+                clauses = [(position, match) for position, match in
+                           enumerate(rule['matches']) if match['type'] == kind]
+                kept = self._holding(pattern['find'], kind,
+                                     [m for _, m in clauses], contexts[kind])
+                for position, match in clauses if kept else ():
+                    rest = [m for m in clauses if m[1] is not match]
+                    if self._holding(pattern['find'], kind, [m for _, m in rest],
+                                     contexts[kind]) == kept:
+                        redundant.append((number, position))
+                        clauses = rest
+                sides[kind] = kept
+            by = self._covering(sides, holds)
+            if by is not None:
+                unreachable.append((number, by))
+            holds.append(sides)
+        return unreachable, redundant
+
+    def _rule_contexts(self, pattern):
+        """Returns the texts before and after a span that the rules of
+        pattern can tell apart, keyed by match type
+
+        Prefix contexts are as long as the longest prefix exact, and suffix
+        contexts one longer than the longest suffix exact, with shorter
+        contexts meeting the start or end of the text. Returns None if
+        analysing the rules against them would check matches more than
+        RULE_CHECKS times, as their number grows exponentially with the
+        length of the exacts.
+
+        """
+        exacts = {'prefix': [''], 'suffix': ['']}
+        # Checks per context: the matches of each rule on each side, and
+        # again without each of them in turn
+        checks = {'prefix': 0, 'suffix': 0}
+        for rule in pattern['rules']:
+            for match in rule['matches']:
+                exacts[match['type']].append(match.get('value', ''))
+            for kind in checks:
+                count = sum(match['type'] == kind for match in rule['matches'])
+                checks[kind] += count * (count + 1)
+        named = set(''.join(exacts['prefix'] + exacts['suffix']))
+        fix = type(self)._fix_string_case.__get__(self)
+        alphabet = sorted(named)
+        kinds = lambda char: (self._is_vowel(char), self._is_consonant(char))
+        for kind in ((True, False), (False, True), (False, False)):
+            stand_in = next((char for char in chain(
+                self.VOWELS + self.CONSONANTS + self.VOWELS.upper() +
+                self.CONSONANTS.upper() + ' ', map(chr, range(0x110000)))
+                if char not in named and fix(char) == char and kinds(char) == kind),
+                None)
+            if stand_in is not None:
+                alphabet.append(stand_in)
+        contexts = {}
+        widths = (max(1, max(map(len, exacts['prefix']))),
+                  max(map(len, exacts['suffix'])) + 1)
+        if sum(checks[kind] * sum(len(alphabet) ** size for size in range(width + 1))
+               for kind, width in zip(('prefix', 'suffix'), widths)) > self.RULE_CHECKS:
+            return None
+        for kind, width in zip(('prefix', 'suffix'), widths):
+            contexts[kind] = [''.join(chars) for size in range(width + 1)
+                              for chars in product(alphabet, repeat=size)]
+        return contexts
+
+    def _holding(self, find, kind, matches, contexts):
+        """Returns the set of contexts, on the kind side of find, in which
+        all of matches hold"""
+        process = type(self)._process_match
+        held = set()
+        for context in contexts:
+            if kind == 'prefix':
+                text, cur = context + find, len(context)
+            else:
+                text, cur = find + context, 0
+            if all(process(self, match, text, cur, cur + len(find))
+                   for match in matches):
+                held.add(context)
+        return frozenset(held)
+
+    @staticmethod
+    def _covering(sides, holds):
+        """Returns the earlier rules, as holds of their prefix and suffix
+        contexts, that cover every context in which sides hold, or None"""
+        by = set()
+        for prefix in sides['prefix']:
+            suffixes = set()
+            for number, earlier in enumerate(holds):
+                if prefix in earlier['prefix'] and earlier['suffix']:
+                    suffixes |= earlier['suffix']
+                    by.add(number)
+            if not sides['suffix'] <= suffixes:
+                return None
+        return tuple(sorted(by)) if sides['suffix'] else ()
+
+    # Patterns and rules left out of the engine's tables, by ruleset,
+    # oldest first
+    _prunings = {}
+    PRUNING_CACHE_SIZE = 16
+
+    def _candidates(self):
+        """Returns the pruned tables the engine matches with
+
+        Returns a tuple of three elements:
+
+        - non rule patterns that can win, keyed by their first character
+        - rule patterns that can win, keyed by their first character
+        - the reachable rules of each rule pattern, keyed by its id
+
+        Patterns keep their order, so the first match is as before.
+
+        """
+        try:
+            return self._pruned
+        except AttributeError:
+            pass
+        # Rulesets from from_ruleset are known by their content hash, and
+        # the rest, made once per class or unpickled, by their contents
+        key = self.__dict__.get('_ruleset_key') or repr(
+            (self.PATTERNS, self.VOWELS, self.CONSONANTS, self.CASESENSITIVES))
+        try:
+            dropped, unreachable = self._prunings[key]
+        except KeyError:
+            dropped, unreachable = self._prunings[key] = self._pruning(self.PATTERNS)
+            if len(self._prunings) > self.PRUNING_CACHE_SIZE:
+                del self._prunings[next(iter(self._prunings))]
+        self._pruned = self._tables(self.PATTERNS, dropped, unreachable, ({}, {}, {}))
+        return self._pruned
+
+    def _pruning(self, patterns):
+        """Returns the positions in patterns of patterns that can never win,
+        and the (position, rule) pairs of rules that can never fire"""
+        unmatchable, shadowed, unreachable, _, _ = self._findings(patterns)
+        return (frozenset(unmatchable + [position for position, _ in shadowed]),
+                frozenset((position, rule) for position, rule, _ in unreachable))
+
+    @staticmethod
+    def _tables(patterns, dropped, unreachable, tables):
+        """Adds patterns to tables as _candidates returns them, leaving out
+        those dropped and their unreachable rules, and returns tables"""
+        for position, pattern in enumerate(patterns):
+            if position in dropped:
+                continue
+            tables['rules' in pattern].setdefault(pattern['find'][:1], []).append(pattern)
+            if 'rules' in pattern:
+                tables[2][id(pattern)] = [
+                    rule for number, rule in enumerate(pattern['rules'])
+                    if (position, number) not in unreachable]
+        return tables
+
+    def overlay(self, delta):
+        """Returns a parser for this parser's ruleset with the patterns of
+        delta layered over it
+
+        delta is a dict, or the path of a JSON file, with a PATTERNS list in
+        the schema of init_data. A pattern whose find is already in the
+        ruleset takes the place of every pattern with that find, and a
+        pattern with a new find is tried before all the others.
+
+        The overlay shares the patterns, rule analysis and matching tables
+        of this parser for every character that no pattern of delta begins
+        with, and only the tables of the rest are built again, so making
+        an overlay costs time and memory in the size of delta. Overlays are
+        cached on this parser by content, so asking for a tenant's overlay
+        on every request is cheap. Raises ValueError if delta is not valid
+        or gives a find twice.
+
+        Usage:
+
+        ::
+        from avrolib import AvroParser
+        avro = AvroParser()
+        tenant = avro.overlay({'PATTERNS': [{'find': 'ph', 'replace': 'ফ'}]})
+        tenant.parse("phon")
+
+        """
+        import hashlib
+        import json
+        if not isinstance(delta, dict):
+            with open(delta, encoding='utf-8') as source:
+                delta = json.load(source)
+        canonical = json.dumps(delta, ensure_ascii=False, sort_keys=True)
+        key = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+        overlays = self.__dict__.setdefault('_overlays', {})
+        if key in overlays:
+            return overlays[key]
+        delta = json.loads(canonical)
+        self._validate_ruleset(dict(delta, VOWELS=self.VOWELS, CONSONANTS=self.CONSONANTS,
+                                    CASESENSITIVES=self.CASESENSITIVES))
+        replacing = {}
+        for pattern in delta['PATTERNS']:
+            if pattern['find'] in replacing:
+                raise ValueError('PATTERNS: %r is given more than once' % pattern['find'])
+            replacing[pattern['find']] = pattern
+        finds = set(pattern['find'] for pattern in self.PATTERNS)
+        patterns = [pattern for pattern in delta['PATTERNS'] if pattern['find'] not in finds]
+        patterns.extend(replacing.get(pattern['find'], pattern) for pattern in self.PATTERNS)
+
+        parser = type(self).__new__(type(self))
+        parser.data = dict(self.data, PATTERNS=patterns)
+        parser._use_data()
+        # Only tables of characters that delta's patterns begin with change
+        touched = set(find[:1] for find in replacing)
+        non_rule, rule, rules = self._candidates()
+        tables = (dict((char, found) for char, found in non_rule.items()
+                       if char not in touched),
+                  dict((char, found) for char, found in rule.items()
+                       if char not in touched),
+                  dict(rules))
+        changed = [pattern for pattern in parser.PATTERNS if pattern['find'][:1] in touched]
+        dropped, unreachable = parser._pruning(changed)
+        parser._pruned = parser._tables(changed, dropped, unreachable, tables)
+        overlays[key] = parser
+        return parser
+
+    def _parse_aligned(self, text, with_spans, with_tokens):
+        """Parses input text, recording its spans and word tokens as asked"""
+        spans = AvroSpans() if with_spans else None
+        tokens = [] if with_tokens else None
+        output = []
+        append = output.append
+        out_end = 0
         fixed_text = self._fix_string_case(self._utf(text))
-        # prepare output list
+        # Positions in fixed text are positions in text unless case fixing
+        # changed its length
+        if len(fixed_text) == len(text):
+            scanned = self._scan(fixed_text)
+        else:
+            scanned = self._scan_source(text)
+        if with_spans:
+            indexes = self._span_indexes()
+        if not with_tokens:
+            for start, end, replaced, pattern, rule in scanned:
+                append(replaced)
+                out_end += len(replaced)
+                index, rules = indexes[id(pattern)]
+                spans._append(end, out_end, index, -1 if rule is None else rules[id(rule)])
+            return ''.join(output), spans
+        # Whether each character of text starts a word, worked out once per
+        # distinct character rather than once per span
+        is_punctuation = self._is_punctuation
+        letters = dict((char, not is_punctuation(char)) for char in set(text))
+        # Source and output start of the word being read, if any
+        word_start = out_word_start = word_end = out_word_end = None
+        for start, end, replaced, pattern, rule in scanned:
+            out_start = out_end
+            append(replaced)
+            out_end += len(replaced)
+            if with_spans:
+                index, rules = indexes[id(pattern)]
+                spans._append(end, out_end, index, -1 if rule is None else rules[id(rule)])
+            if letters[text[start]]:
+                if word_start is None:
+                    word_start, out_word_start = start, out_start
+                word_end, out_word_end = end, out_end
+            elif word_start is not None and out_end > out_start:
+                tokens.append((word_start, word_end, out_word_start, out_word_end))
+                word_start = None
+        if word_start is not None:
+            tokens.append((word_start, word_end, out_word_start, out_word_end))
+        result = (''.join(output),)
+        if with_spans:
+            result += (spans,)
+        if with_tokens:
+            result += (tokens,)
+        return result
+
+    def parse_markup(self, text, protect=None):
+        """Parses input text, passing markup through untouched
+
+        Regions of the kinds named in protect, keys of self.MARKUP that
+        default to self.DEFAULT_MARKUP, are found in one scan beforehand
+        and copied to the output as they are. Only the text between them is
+        matched against patterns, while rules next to a region still see
+        its characters as context, as they would in parse. Inline code,
+        "inline_code", is left out of the default, as "`" is Avro input.
+
+        Usage:
+
+        ::
+        from avrolib import AvroParser
+        avro = AvroParser()
+        avro.parse_markup('<b>ami</b> @rahim ```code``` https://example.com')
+
+        """
+        skips = self._markup_skips(text, tuple(protect if protect is not None
+                                               else self.DEFAULT_MARKUP))
+        return ''.join([span[2] for span in self._scan_source(text, skips=skips)])
+
+    def _markup_skips(self, text, protect):
+        """Returns (start, end, markup) regions of the kinds in protect, as
+        one left to right scan for all of them would find them
+
+        Comments are found with str.find next to the scan rather than by
+        the regex, which would search to the end of text again from every
+        "<!--" that is never closed.
+        """
+        regex = self._markup_regex(protect)
+        opener, closer = self.COMMENT
+        comments = 'tag' in protect and opener in text
+        skips = []
+        pos = 0
+        found = regex.search(text)
+        comment = close = -1
+        while True:
+            if found is not None and found.start() < pos:
+                found = regex.search(text, pos)
+            if comments and comment < pos:
+                comment = text.find(opener, pos)
+                # The first closing after an earlier opening is the first
+                # after this one too, if this one begins before it
+                if comment != -1 and close < comment + len(opener):
+                    close = text.find(closer, comment + len(opener))
+                # No opening from here on is ever closed
+                comments = comment != -1 and close != -1
+            if comments and (found is None or comment <= found.start()):
+                pos = close + len(closer)
+                skips.append((comment, pos, text[comment:pos]))
+            elif found is not None:
+                pos = found.end()
+                skips.append((found.start(), pos, found.group()))
+            else:
+                return skips
+
+    def candidates(self, text, k=5, frequencies=None, beam=16, budget=0.01):
+        """Returns up to k transliterations of text, best first
+
+        Alternatives come from matching any pattern that fits at each
+        position, not only the one that wins, including patterns that
+        differ from text only in the case of case sensitive letters, as
+        in "O" for "o", and from taking the default or any rule
+        replacement of a rule pattern whether or not its rule fires. Each
+        choice that parse would not make costs one. Partial outputs are
+        merged by position, and only the beam cheapest at each position are
+        extended. Each is kept as a link to the one it extends, so the work
+        is linear in the length of text. Once budget seconds have passed,
+        only the cheapest partial output not yet finished is kept, and
+        parse finishes it, so the search takes at most budget seconds
+        and the rest what parse takes over the rest of text.
+
+        Candidates are ranked by their count in frequencies, a mapping of
+        outputs to counts, if given, then by cost. The output of parse is
+        the only candidate that costs nothing, so it comes first unless
+        frequencies rank others above it.
+
+        Usage:
+
+        ::
+        from avrolib import AvroParser
+        avro = AvroParser()
+        avro.candidates("kotha", k=3)
+
+        """
+        fixed = self._fix_string_case(self._utf(text))
+        deadline = time.perf_counter() + budget
+        # Partial outputs ending at each position, keyed by their length and
+        # a polynomial hash of their text so equal outputs merge, as (cost,
+        # link), where a link is (link of the output extended, replaced)
+        modulus = (1 << 61) - 1
+        hashes = {}
+
+        def hashed(replaced):
+            try:
+                return hashes[replaced]
+            except KeyError:
+                value = 0
+                for char in replaced:
+                    value = (value * 1114111 + ord(char)) % modulus
+                found = hashes[replaced] = (pow(1114111, len(replaced), modulus), value)
+                return found
+        states = [{} for _ in range(len(fixed) + 1)]
+        states[-1 if not fixed else 0][0, 0] = (0, None)
+        for cur in range(len(fixed)):
+            found = sorted(states[cur].items(), key=lambda item: item[1][0])[:beam]
+            states[cur] = None
+            if not found:
+                continue
+            if time.perf_counter() > deadline:
+                # The cheapest output yet to be finished may end further on
+                pending = [(cost, link, cur) for _, (cost, link) in found]
+                pending.extend((cost, link, end) for end in range(cur + 1, len(fixed))
+                               for cost, link in states[end].values())
+                cost, link, end = min(pending, key=lambda state: state[0])
+                rest = ''.join([span[2] for span in self._scan(fixed, end)])
+                # Its key only has to differ from those of whole outputs
+                states[-1]['rest'] = (cost, (link, rest))
+                break
+            choices = self._alternatives(fixed, cur)
+            for (length, value), (cost, link) in found:
+                for end, replaced, extra in choices:
+                    power, tail = hashed(replaced)
+                    key = (length + len(replaced), (value * power + tail) % modulus)
+                    total = cost + extra
+                    if total < states[end].get(key, (total + 1,))[0]:
+                        states[end][key] = (total, (link, replaced))
+        outputs = {}
+        for cost, link in states[-1].values():
+            pieces = []
+            while link is not None:
+                link, replaced = link
+                pieces.append(replaced)
+            output = ''.join(reversed(pieces))
+            outputs[output] = min(cost, outputs.get(output, cost))
+        if frequencies is None:
+            frequencies = {}
+        ranked = sorted(outputs.items(),
+                        key=lambda item: (-frequencies.get(item[0], 0), item[1]))
+        return [output for output, _ in ranked[:k]]
+
+    def _alternatives(self, fixed_text, cur):
+        """Returns (end, replaced, cost) for each way of consuming fixed_text
+        at cur, with the choice parse makes first at no cost"""
+        non_rule, rule, _ = self._candidates()
+        _, end, replaced, _, _ = next(self._scan(fixed_text, cur))
+        costs = {(end, replaced): 0}
+        char = fixed_text[cur]
+        firsts = set([char])
+        if self._is_case_sensitive(char):
+            firsts.update((char.lower(), char.upper()))
+        for pattern in chain(*[table.get(first, ()) for table in (non_rule, rule)
+                               for first in sorted(firsts)]):
+            find = pattern['find']
+            end = cur + len(find)
+            window = fixed_text[cur:end]
+            if len(window) != len(find) or any(
+                    a != b and not (self._is_case_sensitive(a) and a.lower() == b.lower())
+                    for a, b in zip(window, find)):
+                continue
+            costs.setdefault((end, pattern['replace']), 1)
+            for rule in pattern.get('rules', ()):
+                costs.setdefault((end, rule['replace']), 1)
+        return sorted(((end, replaced, cost) for (end, replaced), cost in costs.items()),
+                      key=lambda choice: choice[2])
+
+    def parse_autocorrect(self, text, dictionary):
+        """Parses text, replacing whole words and phrases found in an
+        AvroDictionary with their entries instead of parsing them
+
+        Entries match at word boundaries only, the longest first, and
+        bypass pattern and rule matching. Rules of neighbouring text still
+        read the Roman text of a matched entry as their context.
+
+        Usage:
+
+        ::
+        from avrolib import AvroDictionary, AvroParser
+        words = AvroDictionary({'bangla': 'বাংলা', 'ki khobor': 'কী খবর'})
+        AvroParser().parse_autocorrect('ki khobor, ami bangla likhi', words)
+
+        """
+        skips = list(dictionary.matches(text))
+        return ''.join([span[2] for span in self._scan_source(text, skips=skips)])
+
+    def parse_bytes(self, buf):
+        """Parses UTF-8 encoded input and returns UTF-8 encoded output
+
+        Takes bytes, bytearray or memoryview and returns a bytearray equal
+        to parse(buf.decode('utf-8')).encode('utf-8'). Case is fixed with
+        bytes.translate, patterns are matched on the bytes from tables
+        keyed by their first byte and replacements are written from their
+        precomputed encodings, so no span is decoded or encoded. Runs of
+        caseless non-ASCII text, such as Bengali, CJK, symbols, emoji and
+        general punctuation, are copied through without being decoded.
+        Anything else falls back to decoding, as does a ruleset that is not
+        all ASCII or a parser being profiled.
+
+        Usage:
+
+        ::
+        from avrolib import AvroParser
+        avro = AvroParser()
+        avro.parse_bytes(b"ami banglay gan gai")
+
+        """
+        tables = self._byte_tables()
+        if tables is None:
+            return bytearray(self.parse(str(buf, 'utf-8')).encode('utf-8'))
+        runs = {}
+        for run in self._non_ascii.finditer(buf):
+            if not self._caseless_utf8.fullmatch(buf, run.start(), run.end()):
+                return bytearray(self.parse(str(buf, 'utf-8')).encode('utf-8'))
+            runs[run.start()] = run.end()
+        lower, non_rule, rule, encoded = tables
+        fixed = bytes(buf).translate(lower)
+        # Rules read their context from a string, made only once one is
+        # needed. Latin-1 maps each byte to one character, keeping ASCII as
+        # it is and every other byte outside of any letter class
+        text = None
         output = []
-        # cursor end point
-        cur_end = 0
-        # iterate through input text
-        for cur, i in enumerate(fixed_text):
+        append = output.append
+        cur = 0
+        length = len(fixed)
+        while cur < length:
+            byte = fixed[cur]
+            # Finds are all ASCII, so none runs into a non-ASCII run
+            if byte > 127:
+                end = runs[cur]
+                append(fixed[cur:end])
+                cur = end
+                continue
+            for find, replaced in non_rule[byte]:
+                if fixed.startswith(find, cur):
+                    append(replaced)
+                    cur += len(find)
+                    break
+            else:
+                for find, replaced, rules in rule[byte]:
+                    if fixed.startswith(find, cur):
+                        end = cur + len(find)
+                        if text is None:
+                            text = str(fixed, 'latin-1')
+                        fired = self._match_rule(rules, text, cur, end)
+                        append(replaced if fired is None else encoded[fired['replace']])
+                        cur = end
+                        break
+                else:
+                    append(fixed[cur:cur + 1])
+                    cur += 1
+        return bytearray().join(output)
+
+    def _byte_tables(self):
+        """Returns the tables parse_bytes matches with, or None if the
+        ruleset is not all ASCII or the parser is being profiled
+
+        Returns a tuple of the bytes.translate table that fixes case, the
+        (find, replacement) pairs of non rule patterns and the (find,
+        default, rules) triples of rule patterns that can win, each listed
+        by first byte and encoded to UTF-8, and the encoding of every
+        replacement.
+        """
+        if any(name in self.__dict__ for name in self._PROFILED):
+            return None
+        try:
+            return self._bytes
+        except AttributeError:
+            pass
+        encoded = self._encoded_replacements()
+        if encoded is None:
+            self._bytes = None
+            return None
+        non_rule, rule, rules = self._candidates()
+        lower = bytes(ord(self._fix_string_case(chr(code))) if code < 128 else code
+                      for code in range(256))
+        self._bytes = (
+            lower,
+            [[(p['find'].encode('ascii'), encoded[p['replace']])
+              for p in non_rule.get(chr(code), ())] for code in range(128)],
+            [[(p['find'].encode('ascii'), encoded[p['replace']], rules[id(p)])
+              for p in rule.get(chr(code), ())] for code in range(128)],
+            encoded)
+        return self._bytes
+
+    _non_ascii = re.compile(rb'[\x80-\xff]+')
+
+    # UTF-8 of characters that case fixing leaves alone and that no pattern
+    # or letter class includes: Latin-1 punctuation, Indic scripts, general
+    # punctuation, symbols, box drawing, dingbats, CJK and emoji
+    _caseless_utf8 = re.compile(
+        rb'(?:\xc2[\xa0-\xbf]|\xe0[\xa4-\xb7][\x80-\xbf]'
+        rb'|\xe2[\x80-\x83\x87-\x8f\x94-\x9e][\x80-\xbf]'
+        rb'|[\xe3-\xe9][\x80-\xbf]{2}|\xf0\x9f[\x80-\xab][\x80-\xbf])+')
+
+    def _encoded_replacements(self):
+        """Returns a dict of the UTF-8 encoding of every replacement and ASCII
+        character, or None if the ruleset is not all ASCII"""
+        try:
+            return self._encoded
+        except AttributeError:
+            pass
+        chars = set(self.VOWELS + self.CONSONANTS + self.CASESENSITIVES)
+        replacements = set()
+        for pattern in self.PATTERNS:
+            chars.update(pattern['find'])
+            replacements.add(pattern['replace'])
+            for rule in pattern.get('rules', []):
+                replacements.add(rule['replace'])
+                for match in rule['matches']:
+                    chars.update(match.get('value', ''))
+        if all(char < '\x80' for char in chars):
+            replacements.update(chr(code) for code in range(128))
+            self._encoded = dict((r, r.encode('utf-8')) for r in replacements)
+        else:
+            self._encoded = None
+        return self._encoded
+
+    # Kinds of markup parse_markup can pass through, tried in this order
+    MARKUP = {
+        'code': r'```.*?```',
+        'inline_code': r'`[^`\n]+`',
+        # HTML comments are protected along with tags, see _markup_skips
+        'tag': r'</?[A-Za-z][^<>]*>',
+        'url': r'\b(?:https?|ftp)://[^\s<>"]*[^\s<>".,;:!?)\]\']'
+               r'|\bwww\.[^\s<>"]*[^\s<>".,;:!?)\]\']',
+        # A local part is at most 64 characters, which also bounds the work
+        # of trying one from every word boundary of a long run without "@"
+        'email': r'\b[\w.+-]{1,64}@[\w-]+(?:\.[\w-]+)+',
+        'mention': r'(?<!\w)@\w+',
+        'escape': r'\\[^\w\s]|&(?:#[0-9]+|#[xX][0-9a-fA-F]+|%s);' % '|'.join(sorted(
+            (name[:-1] for name in html5 if name.endswith(';')), key=len, reverse=True)),
+    }
+
+    # Kinds of markup parse_markup protects unless told otherwise. A single
+    # "`" is Avro input, so inline code is only protected when asked for
+    DEFAULT_MARKUP = ('code', 'tag', 'url', 'email', 'mention', 'escape')
+
+    # Opening and closing of the HTML comments protected with "tag"
+    COMMENT = ('<!--', '-->')
+
+    _markup_regexes = {}
+
+    @classmethod
+    def _markup_regex(cls, protect):
+        """Returns a regex matching any of the kinds of markup in protect"""
+        try:
+            return cls._markup_regexes[protect]
+        except KeyError:
+            unknown = set(protect) - set(cls.MARKUP)
+            if unknown:
+                raise ValueError('unknown markup: %s' % ', '.join(sorted(unknown)))
+            # An empty alternation would match everywhere, so match nowhere
+            regex = re.compile('|'.join('(?:%s)' % cls.MARKUP[kind]
+                                        for kind in cls.MARKUP if kind in protect)
+                               or '(?!)', re.DOTALL)
+            cls._markup_regexes[protect] = regex
+            return regex
+
+    # Methods shadowed on the instance by counting wrappers while profiling
+    _PROFILED = ('_fix_string_case', '_match_non_rule_patterns',
+                 '_match_rule_patterns', '_match_rule', '_process_match')
+
+    def profile(self, enabled=True):
+        """Turns profiling of this parser on or off
+
+        While profiling is on, the parser counts pattern hits by find, rules
+        fired, rule and clause evaluations, how each span was replaced and
+        the time spent case fixing, matching patterns and evaluating rules.
+        Turning it on resets the counts; turning it off keeps them for
+        profile_stats. It works by shadowing the parser's own methods with
+        wrappers on the instance, so a parser with profiling off runs
+        exactly as before. AvroBatchParser does its own matching and is not
+        counted.
+
+        Usage:
+
+        ::
+        avro = AvroParser()
+        avro.profile()
+        avro.parse("ami banglay gan gai")
+        avro.profile_stats()["patterns"]
+
+        """
+        for name in self._PROFILED:
+            self.__dict__.pop(name, None)
+        if not enabled:
+            return
+        stats = self._profile = {
+            'patterns': Counter(), 'rules': Counter(),
+            'rule_evaluations': 0, 'clause_evaluations': 0,
+            'replacements': Counter(), 'seconds': Counter(),
+        }
+        cls = type(self)
+        patterns, fired, replacements, seconds = (
+            stats['patterns'], stats['rules'], stats['replacements'], stats['seconds'])
+        # Rule lists the engine evaluates, pruned or not, by id to their pattern
+        owners = dict((id(p['rules']), p) for p in self.RULE_PATTERNS)
+        owners.update((id(rules), p) for p in self.RULE_PATTERNS
+                      for rules in [self._candidates()[2].get(id(p))] if rules)
+        clock = time.perf_counter
+
+        def _fix_string_case(text):
+            start = clock()
+            fixed = cls._fix_string_case(self, text)
+            seconds['case'] += clock() - start
+            return fixed
+
+        def _match_non_rule_patterns(fixed_text, cur=0, stop=None):
+            start = clock()
+            match = cls._match_non_rule_patterns(self, fixed_text, cur, stop)
+            seconds['match'] += clock() - start
+            if match['matched']:
+                patterns[match['found']] += 1
+                replacements['pattern'] += 1
+            return match
+
+        def _match_rule_patterns(fixed_text, cur=0, stop=None):
+            start = clock()
+            match = cls._match_rule_patterns(self, fixed_text, cur, stop)
+            seconds['match'] += clock() - start
+            if match['matched']:
+                patterns[match['found']] += 1
+            else:
+                # Only tried once non rule patterns failed, so nothing matched
+                replacements['passthrough'] += 1
+            return match
+
+        def _match_rule(rules, fixed_text, cur=0, cur_end=1):
+            start = clock()
+            rule = cls._match_rule(self, rules, fixed_text, cur, cur_end)
+            seconds['rules'] += clock() - start
+            if rule is None:
+                stats['rule_evaluations'] += len(rules)
+                replacements['default'] += 1
+            else:
+                stats['rule_evaluations'] += next(
+                    i for i, r in enumerate(rules) if r is rule) + 1
+                pattern = owners[id(rules)]
+                fired[pattern['find'], next(
+                    i for i, r in enumerate(pattern['rules']) if r is rule)] += 1
+                replacements['rule'] += 1
+            return rule
+
+        def _process_match(match, fixed_text, cur, cur_end):
+            stats['clause_evaluations'] += 1
+            return cls._process_match(self, match, fixed_text, cur, cur_end)
+
+        self.__dict__.update(
+            _fix_string_case=_fix_string_case,
+            _match_non_rule_patterns=_match_non_rule_patterns,
+            _match_rule_patterns=_match_rule_patterns,
+            _match_rule=_match_rule, _process_match=_process_match)
+
+    def profile_stats(self, reset=False):
+        """Returns a snapshot of the counts gathered since profiling was
+        last turned on, and zeroes them if reset is True
+
+        The snapshot is a dict of:
+
+        - "patterns": hits by pattern find
+        - "rules": times fired by (find, index of the rule in its pattern)
+        - "rule_evaluations", "clause_evaluations": rules and rule matches
+          checked
+        - "replacements": spans replaced by a non rule "pattern", by a
+          "rule", by a rule pattern's "default" or passed through
+          ("passthrough")
+        - "seconds": time spent in "case" fixing, "match"ing patterns and
+          evaluating "rules"
+
+        Raises ValueError if profiling was never turned on.
+
+        """
+        try:
+            stats = self._profile
+        except AttributeError:
+            raise ValueError('profiling was never turned on')
+        snapshot = dict((key, dict(value) if isinstance(value, Counter) else value)
+                        for key, value in stats.items())
+        if reset:
+            for key, value in stats.items():
+                if isinstance(value, Counter):
+                    value.clear()
+                else:
+                    stats[key] = 0
+        return snapshot
+
+    def _span_indexes(self):
+        """Returns a dict of id(pattern) to the position of pattern in
+        self.PATTERNS and a dict of id(rule) to the position of each of its
+        rules, with id(None) mapped to -1
+
+        Rules are found by identity, since equal rules may be listed twice.
+        """
+        try:
+            return self._pattern_indexes
+        except AttributeError:
+            indexes = self._pattern_indexes = dict(
+                (id(p), (index, dict((id(r), i) for i, r in enumerate(p.get('rules', ())))))
+                for index, p in enumerate(self.PATTERNS))
+            indexes[id(None)] = (-1, {})
+            return indexes
+
+    def _scan(self, fixed_text, cur=0, skips=()):
+        """Yields a (start, end, replaced, pattern, rule) tuple for each span
+        of fixed_text consumed by parse, beginning at cursor position cur
+
+        pattern is the pattern that matched the span and rule is the rule of
+        that pattern that fired, each None if there was none. Spans are
+        contiguous and cover fixed_text from cur to its end. Rules
+        are still evaluated against the whole of fixed_text, so text before
+        cur is seen by prefix rules exactly as it would be in a full parse.
+
+        skips is a sorted list of (start, end, replaced) regions that are
+        passed through whole as single spans with the given replacement.
+        Patterns never match across the start of a region, but rules still
+        read its text as context.
+
+        """
+        skips = iter(skips)
+        skip = next(skips, None)
+        while cur < len(fixed_text):
+            # Pass skipped regions through whole
+            while skip is not None and skip[1] <= cur:
+                skip = next(skips, None)
+            if skip is not None and skip[0] <= cur:
+                yield cur, skip[1], skip[2], None, None
+                cur = skip[1]
+                continue
+            stop = None if skip is None else skip[0]
+            i = fixed_text[cur]
             # Trap characters with unicode encoding errors
             try:
                 i.encode('utf-8')
             except UnicodeDecodeError:
-                uni_pass = False
+                yield cur, cur + 1, i, None, None
+                cur += 1
+                continue
+            # Try looking in non rule self.PATTERNS with current string portion
+            match = self._match_non_rule_patterns(fixed_text, cur, stop)
+            # Check if non rule self.PATTERNS have matched
+            rule = None
+            if match["matched"]:
+                cur_end = cur + len(match["found"])
+                replaced = match["replaced"]
             else:
-                uni_pass = True
-            # Default value for match
-            match = {'matched': False}
-            # Check cur is greater than or equals cur_end. If cursor is in
-            # a position that has alread been processed/replaced, we don't
-            # process anything at all
-            if not uni_pass:
-                cur_end = cur + 1
-                output.append(i)
-            elif cur >= cur_end and uni_pass:
-                # Try looking in non rule self.PATTERNS with current string portion
-                match = self._match_non_rule_patterns(fixed_text, cur)
-                # Check if non rule self.PATTERNS have matched
+                # if non rule self.PATTERNS have not matched, try rule self.PATTERNS
+                match = self._match_rule_patterns(fixed_text, cur, stop)
+                # Check if rule self.PATTERNS have matched
                 if match["matched"]:
-                    output.append(match["replaced"])
+                    # Update cur_end as cursor + length of match found
                     cur_end = cur + len(match["found"])
+                    # Process its rules
+                    rule = self._match_rule(rules = match["rules"],
+                                            fixed_text = fixed_text,
+                                            cur = cur, cur_end = cur_end)
+                    # If a rule matches, output its replacement, else output
+                    # it's default top-level/default replacement
+                    if rule is not None:
+                        replaced = rule['replace']
+                    else:
+                        replaced = match["replaced"]
                 else:
-                # if non rule self.PATTERNS have not matched, try rule self.PATTERNS
-                    match = self._match_rule_patterns(fixed_text, cur)
-                    # Check if rule self.PATTERNS have matched
-                    if match["matched"]:
-                        # Update cur_end as cursor + length of match found
-                        cur_end =  cur + len(match["found"])
-                        # Process its rules
-                        replaced = self._process_rules(rules = match["rules"],
-                                                fixed_text = fixed_text,
-                                                cur = cur, cur_end = cur_end)
-                        # If any rules match, output replacement from the
-                        # rule, else output it's default top-level/default
-                        # replacement
-                        if replaced is not None:
-                            # Rule has matched
-                            output.append(replaced)
-                        else:
-                            # No rules have matched
-                            # output common match
-                            output.append(match["replaced"])
-
-                # If none matched, append present cursor value
-                if not match["matched"]:
+                    # If none matched, pass present cursor value through
                     cur_end = cur + 1
-                    output.append(i)
+                    replaced = i
+            yield cur, cur_end, replaced, match["pattern"], rule
+            cur = cur_end
+
+    def _scan_source(self, text, cur=0, skips=()):
+        """Yields spans like _scan, but takes text and skipped regions before
+        case fixing and gives positions in it
+
+        Case fixing may turn one character into several. A span boundary
+        that falls inside such a character joins the spans on either side,
+        keeping the pattern and rule of the first.
+
+        """
+        fixed_text = self._fix_string_case(self._utf(text))
+        if len(fixed_text) == len(text):
+            for span in self._scan(fixed_text, cur, skips):
+                yield span
+            return
+        # Map source positions to fixed ones and back
+        positions = [0]
+        for char in text:
+            positions.append(positions[-1] + len(self._fix_string_case(char)))
+        sources = dict((pos, index) for index, pos in enumerate(positions))
+        skips = [(positions[start], positions[end], replaced)
+                 for start, end, replaced in skips]
+        joined, parts = None, []
+        for start, end, replaced, pattern, rule in self._scan(
+                fixed_text, positions[min(cur, len(text))], skips):
+            if joined is None:
+                joined = sources[start], pattern, rule
+            parts.append(replaced)
+            if end in sources:
+                yield joined[0], sources[end], ''.join(parts), joined[1], joined[2]
+                joined, parts = None, []
+
+    def _splits_on_whitespace(self):
+        """Check if text can be parsed a piece at a time between whitespace
+
+        Holds when no pattern or exact rule context includes whitespace.
+        Whitespace then passes through as itself, and reads as punctuation
+        to its neighbours just like the start or end of text does. The end
+        of text is not read like whitespace by suffix exact rules, which
+        never match a value ending there, so pieces must keep the
+        whitespace that follows them.
+        """
+        chars = set()
+        for pattern in self.PATTERNS:
+            chars.update(pattern['find'])
+            for rule in pattern.get('rules', []):
+                for match in rule['matches']:
+                    chars.update(match.get('value', ''))
+        return not any(char.isspace() for char in chars)
 
-        # End looping through input text and produce output
-        return ''.join(output)
+    def _reach(self):
+        """Returns how far parse may look around the start of a span
 
-    def _match_non_rule_patterns(self, fixed_text, cur=0):
+        Returns a tuple of two elements:
+
+        - left - int: characters before the span start read by prefix rules
+        - right - int: characters from the span start read to match a
+        pattern and evaluate its suffix rules, including the end of text check
+
+        A span is unaffected by edits that happen at or beyond start + right,
+        and only depends on text from start - left onwards.
+
+        """
+        left = 0
+        right = max(len(p['find']) for p in self.PATTERNS)
+        for pattern in self.RULE_PATTERNS:
+            for rule in pattern['rules']:
+                for match in rule['matches']:
+                    if not match['scope'].endswith('exact'):
+                        reach = 1
+                    elif match['type'] == 'prefix':
+                        reach = len(match['value'])
+                    else:
+                        # suffix exacts also check that text goes on past them
+                        reach = len(match['value']) + 1
+                    if match['type'] == 'prefix':
+                        left = max(left, reach)
+                    else:
+                        right = max(right, len(pattern['find']) + reach)
+        return left, right
+
+    def _match_non_rule_patterns(self, fixed_text, cur=0, stop=None):
         """Matches given text at cursor position with non rule self.PATTERNS
 
-        Returns a dictionary of three elements:
+        Patterns must end by stop, if given, instead of the end of the text.
+
+        Returns a dictionary of four elements:
 
         - "matched" - Bool: depending on if match found
         - "found" - string/None: Value of matched pattern's 'find' key or none
         - "replaced": string Replaced string if match found else input string at
         cursor
+        - "pattern": dict/None: The matched pattern or None if no match found
 
         """
-        pattern = self._exact_find_in_pattern(fixed_text, cur, self.NON_RULE_PATTERNS)
+        try:
+            table = self._pruned[0]
+        except AttributeError:
+            table = self._candidates()[0]
+        pattern = self._exact_find_in_pattern(fixed_text, cur,
+                                              table.get(fixed_text[cur], ()), stop)
         if len(pattern) > 0:
             return {"matched": True, "found": pattern[0]['find'],
-                    "replaced": pattern[0]['replace']}
+                    "replaced": pattern[0]['replace'], "pattern": pattern[0]}
         else:
             return {"matched": False, "found": None,
-                    "replaced": fixed_text[cur]}
+                    "replaced": fixed_text[cur], "pattern": None}
 
-    def _match_rule_patterns(self, fixed_text, cur=0):
+    def _match_rule_patterns(self, fixed_text, cur=0, stop=None):
         """Matches given text at cursor position with rule self.PATTERNS
 
-        Returns a dictionary of four elements:
+        Patterns must end by stop, if given, instead of the end of the text.
+
+        Returns a dictionary of five elements:
 
         - "matched" - Bool: depending on if match found
         - "found" - string/None: Value of matched pattern's 'find' key or none
         - "replaced": string Replaced string if match found else input string at
         cursor
-        - "rules": dict/None: A dict of rules or None if no match found
+        - "rules": list/None: The pattern's rules that can fire, or None if
+        no match found
+        - "pattern": dict/None: The matched pattern or None if no match found
 
         """
-        pattern = self._exact_find_in_pattern(fixed_text, cur, self.RULE_PATTERNS)
+        try:
+            pruned = self._pruned
+        except AttributeError:
+            pruned = self._candidates()
+        pattern = self._exact_find_in_pattern(fixed_text, cur,
+                                              pruned[1].get(fixed_text[cur], ()), stop)
         # if len(pattern) == 1:
         if len(pattern) > 0:
             return {"matched": True, "found": pattern[0]['find'],
-                    "replaced": pattern[0]['replace'], "rules": pattern[0]['rules']}
+                    "replaced": pattern[0]['replace'], "rules": pruned[2][id(pattern[0])],
+                    "pattern": pattern[0]}
         else:
             return {"matched": False, "found": None,
-                    "replaced": fixed_text[cur], "rules": None}
+                    "replaced": fixed_text[cur], "rules": None, "pattern": None}
 
-    def _exact_find_in_pattern(self, fixed_text, cur = 0, PATTERNS = None):
+    def _exact_find_in_pattern(self, fixed_text, cur = 0, PATTERNS = None, stop = None):
         """Returns pattern items that match given text, cur position and pattern"""
         if PATTERNS is None: PATTERNS = self.PATTERNS
-        return [x for x in PATTERNS if (cur + len(x['find']) <= len(fixed_text))
+        if stop is None: stop = len(fixed_text)
+        return [x for x in PATTERNS if (cur + len(x['find']) <= stop)
                 and x['find'] == fixed_text[cur:(cur + len(x['find']))]]
 
     def _process_rules(self, rules, fixed_text, cur = 0, cur_end = 1):
@@ -145,7 +1371,15 @@ class AvroParser():
         else output None
 
         """
-        replaced = ''
+        rule = self._match_rule(rules, fixed_text, cur, cur_end)
+        if rule is not None:
+            return rule['replace']
+        else:
+            return None
+
+    def _match_rule(self, rules, fixed_text, cur = 0, cur_end = 1):
+        """Returns the first of rules whose matches are all satisfied, or
+        None if there is none"""
         # iterate through rules
         for rule in rules:
             matched = False
@@ -158,14 +1392,8 @@ class AvroParser():
                     break
             # If a match is found, stop looping through rules any further
             if matched:
-                replaced = rule['replace']
-                break
-
-        # if any match has been found return replace value
-        if matched:
-            return replaced
-        else:
-            return None
+                return rule
+        return None
 
     def _process_match(self, match, fixed_text, cur, cur_end):
         """Processes a single match in rules"""
@@ -2032,3 +3260,1867 @@ class AvroParser():
             "CASESENSITIVES": "oiudgjnrstyz",
             "DIGITS": "0123456789"
         }
+
+
+
+class AvroSpans():
+    """Alignment of the input spans consumed by parse with their output
+
+    Spans are contiguous, so each is stored as the next of a run of source
+    and output offsets, along with the index in PATTERNS of the pattern that
+    matched it and the index in that pattern's rules of the rule that fired.
+    Both indexes are -1 where there was none.
+
+    Usage:
+
+    ::
+    from avrolib import AvroParser
+    output, spans = AvroParser().parse("ami", with_spans=True)
+    spans[0]
+    spans.source_to_output(2)
+
+    """
+
+    Span = namedtuple('Span', ['source_start', 'source_end', 'output_start',
+                               'output_end', 'pattern', 'rule'])
+
+    def __init__(self):
+        self.source_offsets = array('l', [0])
+        self.output_offsets = array('l', [0])
+        self.patterns = array('i')
+        self.rules = array('i')
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('span index out of range')
+        return self.Span(self.source_offsets[index], self.source_offsets[index + 1],
+                         self.output_offsets[index], self.output_offsets[index + 1],
+                         self.patterns[index], self.rules[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def source_to_output(self, offset):
+        """Returns the output offset of the span holding source offset"""
+        index = bisect_right(self.source_offsets, offset) - 1
+        return self.output_offsets[max(index, 0)]
+
+    def output_to_source(self, offset):
+        """Returns the source offset of the span holding output offset"""
+        index = bisect_right(self.output_offsets, offset) - 1
+        return self.source_offsets[max(index, 0)]
+
+    def _append(self, source_end, output_end, pattern, rule):
+        self.source_offsets.append(source_end)
+        self.output_offsets.append(output_end)
+        self.patterns.append(pattern)
+        self.rules.append(rule)
+
+class AvroDictionary():
+    """Whole word and phrase replacements, stored as a packed trie
+
+    Takes a mapping, or pairs, of Roman keys to their replacements. Keys
+    are matched exactly, case included. The trie lives in flat arrays:
+    the edges of node n are edges first[n] to first[n + 1], sorted by
+    character, and values are slices of one joined string, so memory is a
+    few machine words per key character rather than a dict of strings.
+
+    Usage:
+
+    ::
+    from avrolib import AvroDictionary
+    words = AvroDictionary({'bangla': 'বাংলা', 'ki khobor': 'কী খবর'})
+    list(words.matches('ki khobor, bangla'))
+
+    """
+
+    # Characters that continue a word, so entries cannot start or end
+    # next to them
+    _word = re.compile(r'[\w`]')
+
+    def __init__(self, entries):
+        if hasattr(entries, 'items'):
+            entries = entries.items()
+        items = sorted(dict(entries).items())
+        for key, value in items:
+            if not isinstance(key, str) or not key or not isinstance(value, str):
+                raise ValueError('entries must map non-empty strings to strings: '
+                                 '%r: %r' % (key, value))
+        self._first = array('l')
+        self._labels = array('l')
+        self._targets = array('l')
+        self._value = array('l')
+        self._offsets = array('l', [0])
+        self._values = ''.join(value for _, value in items)
+        for _, value in items:
+            self._offsets.append(self._offsets[-1] + len(value))
+        # Nodes are numbered breadth first, so each node's edges follow
+        # those of the node before it. A node is a run of items sharing
+        # the key prefix of length depth
+        nodes = [(0, len(items), 0)]
+        for lo, hi, depth in nodes:
+            self._first.append(len(self._labels))
+            if lo < hi and len(items[lo][0]) == depth:
+                self._value.append(lo)
+                lo += 1
+            else:
+                self._value.append(-1)
+            while lo < hi:
+                char = items[lo][0][depth]
+                end = lo
+                while end < hi and items[end][0][depth] == char:
+                    end += 1
+                self._labels.append(ord(char))
+                self._targets.append(len(nodes))
+                nodes.append((lo, end, depth + 1))
+                lo = end
+        self._first.append(len(self._labels))
+
+    @classmethod
+    def from_file(cls, path):
+        """Returns the dictionary of a JSON object of keys to replacements"""
+        import json
+        with open(path, encoding='utf-8') as source:
+            return cls(json.load(source))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def get(self, key, default=None):
+        """Returns the replacement of key, or default if there is none"""
+        node = 0
+        for char in key:
+            lo, hi = self._first[node], self._first[node + 1]
+            edge = bisect_left(self._labels, ord(char), lo, hi)
+            if edge == hi or self._labels[edge] != ord(char):
+                return default
+            node = self._targets[edge]
+        if self._value[node] < 0:
+            return default
+        return self._entry(self._value[node])
+
+    def matches(self, text):
+        """Yields (start, end, replacement) for each entry found in text
+
+        Entries must start and end at word boundaries. At each word start
+        the longest entry wins, and matching goes on after its end.
+        """
+        first, labels, targets, value = self._first, self._labels, self._targets, self._value
+        word = self._word
+        size = len(text)
+        end = 0
+        for found in word.finditer(text):
+            start = found.start()
+            if start < end or start and word.match(text, start - 1):
+                continue
+            node = 0
+            best = None
+            cur = start
+            while cur < size:
+                code = ord(text[cur])
+                lo, hi = first[node], first[node + 1]
+                edge = bisect_left(labels, code, lo, hi)
+                if edge == hi or labels[edge] != code:
+                    break
+                node = targets[edge]
+                cur += 1
+                if value[node] >= 0 and not (cur < size and word.match(text, cur)):
+                    best = cur, value[node]
+            if best is not None:
+                end = best[0]
+                yield start, end, self._entry(best[1])
+
+    def _entry(self, index):
+        return self._values[self._offsets[index]:self._offsets[index + 1]]
+
+
+class AvroSearchIndex():
+    """Finds Bengali words by their Roman spelling, by prefix
+
+    Words and queries are turned into phonetic keys in the same key space.
+    A word's key is its Bengali text folded so that letters the ruleset
+    writes for the same Roman letters, whatever their case, become one,
+    as in ি and ই for "i" and "I", or শ and ষ for "sh" and "Sh". The
+    hasanta and joiners are dropped, as are the vowels of "o", whose
+    default writes nothing and which rules write as অ or ও. A query's key
+    is the same fold of the default replacements of the patterns it
+    matches, found in the parser's tables without evaluating any rule,
+    since the rules of vowels only choose between forms the fold makes
+    equal.
+
+    Entries are kept as one sorted list of key and word strings, so a
+    prefix query is a binary search and a scan of the matching run.
+
+    Usage:
+
+    ::
+    from avrolib import AvroSearchIndex
+    index = AvroSearchIndex()
+    index.add_text('আমি বাংলায় গান গাই')
+    index.query('bangla')
+
+    """
+
+    # Separates the key of an entry from its word, and sorts before both
+    _SEPARATOR = '\x00'
+    _bengali = re.compile('[ঀ-৿‌‍]+')
+
+    def __init__(self, parser=None, words=()):
+        if parser is None:
+            parser = _default_parser()
+        self.parser = parser
+        self._fold = self._folding(parser)
+        self._entries = []
+        self.extend(words)
+
+    @staticmethod
+    def _folding(parser):
+        """Returns a str.translate table folding Bengali text to keys"""
+        dropped = '্‌‍অ'
+
+        def strip(output):
+            return ''.join(char for char in output if char not in dropped)
+
+        def vowel(output):
+            return len(output) == 1 and ('অ' <= output <= 'ঔ' or 'া' <= output <= 'ৌ')
+        groups = {}
+        for pattern in parser.PATTERNS:
+            default = strip(pattern['replace'])
+            letters = groups.setdefault(pattern['find'].lower(), set())
+            if len(default) == 1 and 'ঀ' <= default <= '৿':
+                letters.add(default)
+            # Rules of vowels choose between a sign and a full vowel, or,
+            # where the vowel is inherent, whether to write it at all
+            if default and not vowel(default):
+                continue
+            outputs = set(strip(rule['replace']) for rule in pattern.get('rules', ()))
+            outputs = set(output for output in outputs if vowel(output))
+            if outputs:
+                letters.update(outputs)
+                if not default:
+                    letters.add('')
+        # Join groups sharing a letter, and map each letter to the least
+        leader = {}
+
+        def find(char):
+            while leader.get(char, char) != char:
+                char = leader[char]
+            return char
+        for letters in groups.values():
+            if not letters:
+                continue
+            first = find(min(letters))
+            for letter in letters:
+                root = find(letter)
+                if root != first:
+                    leader[max(root, first)] = min(root, first)
+                    first = min(root, first)
+        table = dict((ord(char), None) for char in dropped)
+        table.update((ord(char), find(char) or None) for char in leader if char)
+        return table
+
+    def key(self, word):
+        """Returns the phonetic key of a Bengali word"""
+        return word.translate(self._fold)
+
+    def roman_key(self, text):
+        """Returns the phonetic key of Roman text"""
+        return self._roman_keys(text)[0]
+
+    def _roman_keys(self, text, prefix=False):
+        """Returns a list of the phonetic key of Roman text and, if prefix
+        is True, the keys that words text is the beginning of may have
+        instead
+
+        Text ending partway through a longer find, as "shikk" does in
+        "shikkh" or "ban" in "bang", is matched otherwise once the word
+        goes on. Each such find, tried before the pattern matched where it
+        begins, adds the key of the text before it and its replacement.
+        """
+        parser = self.parser
+        fixed = parser._fix_string_case(parser._utf(text))
+        non_rule, rule, _ = parser._candidates()
+        output = []
+        keys = []
+        cur = 0
+        while cur < len(fixed):
+            found = None
+            for pattern in chain(non_rule.get(fixed[cur], ()), rule.get(fixed[cur], ())):
+                if fixed.startswith(pattern['find'], cur):
+                    found = pattern
+                    break
+                if prefix and len(pattern['find']) > len(fixed) - cur and \
+                        pattern['find'].startswith(fixed[cur:]):
+                    keys.append(''.join(output) + pattern['replace'])
+            if found is None:
+                output.append(fixed[cur])
+                cur += 1
+            else:
+                output.append(found['replace'])
+                cur += len(found['find'])
+        keys.insert(0, ''.join(output))
+        return [key.translate(self._fold) for key in keys]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, word):
+        entry = self.key(word) + self._SEPARATOR + word
+        at = bisect_left(self._entries, entry)
+        return at < len(self._entries) and self._entries[at] == entry
+
+    def add(self, word):
+        """Adds a Bengali word, if it is not in the index already"""
+        entry = self.key(word) + self._SEPARATOR + word
+        at = bisect_left(self._entries, entry)
+        if at == len(self._entries) or self._entries[at] != entry:
+            self._entries.insert(at, entry)
+
+    def remove(self, word):
+        """Removes a Bengali word, raising KeyError if it is not there"""
+        entry = self.key(word) + self._SEPARATOR + word
+        at = bisect_left(self._entries, entry)
+        if at == len(self._entries) or self._entries[at] != entry:
+            raise KeyError(word)
+        del self._entries[at]
+
+    def extend(self, words):
+        """Adds many Bengali words at once, sorting only once"""
+        separator = self._SEPARATOR
+        fold = self._fold
+        entries = set(word.translate(fold) + separator + word for word in words)
+        if entries:
+            entries.update(self._entries)
+            self._entries = sorted(entries)
+
+    def add_text(self, text):
+        """Adds every run of Bengali script in text as a word"""
+        self.extend(self._bengali.findall(text))
+
+    def query(self, text, limit=20, prefix=True):
+        """Returns up to limit words whose key begins with the key of the
+        Roman query text, or equals it if prefix is False
+
+        Words whose key equals the query's come first, then the rest in key
+        order. A prefix query may end partway through a letter, so "ban"
+        finds বাংলা as "bang" does, and "shikk" finds শিক্ষা as "shik" and
+        "shikkh" do, and a longer query never finds a word a shorter one
+        misses.
+        """
+        separator = self._SEPARATOR
+        keys = self._roman_keys(text, prefix)
+        if not prefix:
+            keys = [keys[0] + separator]
+        entries = self._entries
+        # The first limit entries of every key's run hold the first limit
+        # of them all
+        found = set()
+        for key in set(keys):
+            at = bisect_left(entries, key)
+            end = min(len(entries), at + limit)
+            while at < end and entries[at].startswith(key):
+                found.add(entries[at])
+                at += 1
+        exact = keys[0] if not prefix else keys[0] + separator
+        found = sorted(found, key=lambda entry: (not entry.startswith(exact), entry))
+        return [entry.split(separator, 1)[1] for entry in found[:limit]]
+
+
+class AvroSession():
+    """Keystroke-level transliteration of a growing buffer
+
+    Keeps the spans of the last parse so that each append or backspace only
+    re-parses the tail that the edit can affect. That tail is bounded by the
+    longest pattern and the longest rule context, so the work done per
+    keystroke does not grow with the buffer.
+
+    Usage:
+
+    ::
+    from avrolib import AvroSession
+    session = AvroSession()
+    session.append('am')
+    session.append('i')
+    session.backspace()
+    session.output
+
+    """
+
+    Edit = namedtuple('Edit', ['delete', 'insert'])
+
+    def __init__(self, parser=None, text=''):
+        self.parser = parser if parser is not None else AvroParser()
+        self.left, self.right = self.parser._reach()
+        # source characters as typed
+        self._source = []
+        # case fixed characters, which is what spans index into
+        self._fixed = []
+        # start position in self._fixed and replacement of each span
+        self._starts = []
+        self._replaced = []
+        if text:
+            self.append(text)
+
+    @property
+    def text(self):
+        """Source text typed so far"""
+        return ''.join(self._source)
+
+    @property
+    def output(self):
+        """Transliteration of the source text typed so far"""
+        return ''.join(self._replaced)
+
+    def append(self, text):
+        """Appends text to the buffer and returns the resulting output edit
+
+        Returns an Edit of two elements:
+
+        - "delete" - int: number of characters to remove from the end of the
+        previous output
+        - "insert" - string: characters to add after that removal
+
+        """
+        edit_at = len(self._fixed)
+        self._source.extend(text)
+        self._fixed.extend(self.parser._fix_string_case(self.parser._utf(text)))
+        return self._reparse(edit_at)
+
+    def backspace(self, count=1):
+        """Removes count characters from the end of the buffer and returns
+        the resulting output edit, as for append"""
+        count = min(count, len(self._source))
+        if count == 0:
+            return self.Edit(0, '')
+        removed = ''.join(self._source[-count:])
+        del self._source[-count:]
+        width = len(self.parser._fix_string_case(self.parser._utf(removed)))
+        del self._fixed[len(self._fixed) - width:]
+        return self._reparse(len(self._fixed))
+
+    def reset(self):
+        """Clears the buffer"""
+        del self._source[:], self._fixed[:], self._starts[:], self._replaced[:]
+
+    def _reparse(self, edit_at):
+        """Re-parses every span that may be affected by an edit at position
+        edit_at of self._fixed and returns the output edit"""
+        # Walk back over spans that could have read past edit_at
+        first = len(self._starts)
+        while first > 0 and self._starts[first - 1] + self.right > edit_at:
+            first -= 1
+        restart = self._starts[first] if first < len(self._starts) else edit_at
+        old_tail = ''.join(self._replaced[first:])
+        del self._starts[first:], self._replaced[first:]
+        # Parse from restart, keeping enough text before it for prefix rules
+        window_start = max(0, restart - self.left)
+        window = ''.join(self._fixed[window_start:])
+        for span in self.parser._scan(window, restart - window_start):
+            self._starts.append(window_start + span[0])
+            self._replaced.append(span[2])
+        new_tail = ''.join(self._replaced[first:])
+        # Keep the part of the output that did not change
+        common = 0
+        limit = min(len(old_tail), len(new_tail))
+        while common < limit and old_tail[common] == new_tail[common]:
+            common += 1
+        return self.Edit(len(old_tail) - common, new_tail[common:])
+
+
+
+class _SpanBlock():
+    """A run of consecutive spans of an AvroDocument and their source text"""
+
+    __slots__ = ('text', 'lengths', 'replaced', 'out_len')
+
+    def __init__(self, text, lengths, replaced):
+        self.text = text
+        self.lengths = lengths
+        self.replaced = replaced
+        self.out_len = sum(len(r) for r in replaced)
+
+
+class AvroDocument():
+    """Transliteration of a document kept up to date under range edits
+
+    The spans of the last parse are stored in blocks that carry their
+    source and output lengths, along with the source and output offsets at
+    which every block begins, so the block holding an offset is found by
+    binary search. An edit re-parses from the first span that could have
+    read the edited range, and stops as soon as the new spans line up again
+    with the old ones past the edit and its rule context. Edits in the
+    middle of a document cost the same as edits at its end.
+
+    Usage:
+
+    ::
+    from avrolib import AvroDocument
+    doc = AvroDocument(text='ami banglay gan gai')
+    doc.edit(4, 7, 'bangla')
+    doc.output
+
+    """
+
+    Edit = namedtuple('Edit', ['start', 'delete', 'insert'])
+
+    # Number of spans in each block
+    BLOCK_SIZE = 256
+
+    def __init__(self, parser=None, text=''):
+        self.parser = parser if parser is not None else AvroParser()
+        self.left, self.right = self.parser._reach()
+        spans = list(self.parser._scan_source(text))
+        self._blocks = []
+        # Source and output offsets at which each block begins, followed by
+        # those of the end of the document, less the pending shifts from
+        # index self._stale on
+        self._src_starts = [0]
+        self._out_starts = [0]
+        self._stale = 0
+        self._src_shift = self._out_shift = 0
+        self._splice(0, 0, self._make_blocks(text,
+                                             [span[1] - span[0] for span in spans],
+                                             [span[2] for span in spans]))
+
+    def __len__(self):
+        return self._offsets(len(self._blocks))[0]
+
+    @property
+    def text(self):
+        """Source text of the document"""
+        return ''.join(block.text for block in self._blocks)
+
+    @property
+    def output(self):
+        """Transliteration of the document"""
+        return ''.join(''.join(block.replaced) for block in self._blocks)
+
+    def edit(self, offset, delete=0, insert=''):
+        """Replaces delete source characters at offset with insert
+
+        Returns an Edit of three elements describing the matching change to
+        the output:
+
+        - "start" - int: output offset where the change begins
+        - "delete" - int: number of output characters removed there
+        - "insert" - string: output characters put in their place
+
+        """
+        size = len(self)
+        if offset < 0 or delete < 0 or offset + delete > size:
+            raise ValueError('edit range %d:%d is outside the document of '
+                             'length %d' % (offset, offset + delete, size))
+        # Spans starting at or before offset - right cannot have read the edit
+        first, src_base, out_base = self._locate(max(0, offset - self.right))
+        last = self._locate(offset + delete)[0]
+        context = self._context(first)
+        while True:
+            result = self._reparse(first, last, context, offset - src_base,
+                                   delete, insert)
+            if result is not None:
+                break
+            # The new spans ran into text not yet in the window; widen it
+            last += 1
+        out_start, old_out, new_out, blocks = result
+        self._splice(first, last + 1, blocks)
+        # Only report the part of the output that did change
+        prefix = 0
+        limit = min(len(old_out), len(new_out))
+        while prefix < limit and old_out[prefix] == new_out[prefix]:
+            prefix += 1
+        suffix = 0
+        limit -= prefix
+        while (suffix < limit and
+               old_out[len(old_out) - suffix - 1] == new_out[len(new_out) - suffix - 1]):
+            suffix += 1
+        return self.Edit(out_base + out_start + prefix,
+                         len(old_out) - prefix - suffix,
+                         new_out[prefix:len(new_out) - suffix])
+
+    def source_to_output(self, offset):
+        """Returns the output offset of the span holding source offset"""
+        index, src, out = self._locate(offset)
+        for length, replaced in self._spans(index):
+            if offset < src + length:
+                break
+            src += length
+            out += len(replaced)
+        return out
+
+    def output_to_source(self, offset):
+        """Returns the source offset of the span holding output offset"""
+        index, src, out = self._locate(offset, output=True)
+        for length, replaced in self._spans(index):
+            if offset < out + len(replaced):
+                break
+            src += length
+            out += len(replaced)
+        return src
+
+    def _spans(self, index):
+        """Returns (length, replaced) pairs of the spans in block index"""
+        if index >= len(self._blocks):
+            return []
+        block = self._blocks[index]
+        return zip(block.lengths, block.replaced)
+
+    def _locate(self, offset, output=False):
+        """Finds the block holding a source, or output, offset
+
+        Returns a tuple of its index and the source and output offsets at
+        which it begins. Offsets at the end of the document belong to the
+        last block.
+
+        """
+        count = len(self._blocks)
+        if not count:
+            return 0, 0, 0
+        if output:
+            starts, shift = self._out_starts, self._out_shift
+        else:
+            starts, shift = self._src_starts, self._src_shift
+        stale = self._stale
+        if stale < count and starts[stale] + shift <= offset:
+            index = bisect_right(starts, offset - shift, stale, count) - 1
+        else:
+            index = bisect_right(starts, offset, 0, min(stale, count)) - 1
+        index = max(index, 0)
+        return (index,) + self._offsets(index)
+
+    def _splice(self, first, end, blocks):
+        """Puts blocks in place of the blocks from first up to end
+
+        Offsets of the blocks after them move by the change in length. They
+        are stored less a pending shift from self._stale on, so that only
+        the offsets between the last edit and this one are rewritten.
+
+        """
+        end = min(end, len(self._blocks))
+        self._settle(end + 1)
+        src, out = self._src_starts[first], self._out_starts[first]
+        src_starts, out_starts = [], []
+        for block in blocks:
+            src_starts.append(src)
+            out_starts.append(out)
+            src += len(block.text)
+            out += block.out_len
+        self._src_shift += src - self._src_starts[end]
+        self._out_shift += out - self._out_starts[end]
+        src_starts.append(src)
+        out_starts.append(out)
+        self._src_starts[first:end + 1] = src_starts
+        self._out_starts[first:end + 1] = out_starts
+        self._blocks[first:end] = blocks
+        self._stale = first + len(src_starts)
+
+    def _settle(self, index):
+        """Makes the offsets of blocks before index exact, and those from
+        index on stored less the pending shift"""
+        src_starts, out_starts = self._src_starts, self._out_starts
+        if index > self._stale:
+            src_shift, out_shift = self._src_shift, self._out_shift
+            positions = range(self._stale, index)
+        else:
+            src_shift, out_shift = -self._src_shift, -self._out_shift
+            positions = range(index, self._stale)
+        for position in positions:
+            src_starts[position] += src_shift
+            out_starts[position] += out_shift
+        self._stale = index
+
+    def _offsets(self, index):
+        """Returns the source and output offsets at which block index begins,
+        or the document ends if index is the number of blocks"""
+        if index < self._stale:
+            return self._src_starts[index], self._out_starts[index]
+        return (self._src_starts[index] + self._src_shift,
+                self._out_starts[index] + self._out_shift)
+
+    def _context(self, index):
+        """Returns the source text prefix rules may read before block index"""
+        context = ''
+        while self.left and len(context) < self.left and index > 0:
+            index -= 1
+            context = self._blocks[index].text + context
+        return context[len(context) - self.left:] if self.left else ''
+
+    def _reparse(self, first, last, context, rel, delete, insert):
+        """Applies an edit at rel within blocks first to last
+
+        Returns a tuple of the output offset within those blocks where the
+        re-parsed spans begin, their old and new output, and the blocks to
+        put in place of the old ones. Returns None if the blocks end before
+        the new spans line up with the old ones again.
+
+        """
+        work = self._blocks[first:last + 1]
+        at_end = last >= len(self._blocks) - 1
+        old_text = ''.join(block.text for block in work)
+        lengths = [length for block in work for length in block.lengths]
+        replaced = [r for block in work for r in block.replaced]
+        new_text = old_text[:rel] + insert + old_text[rel + delete:]
+        delta = len(insert) - delete
+        # First span that may read the edit, and old spans past the edit
+        start, skip, old_starts = 0, None, {}
+        for index, length in enumerate(lengths):
+            if skip is None and start + self.right > rel:
+                skip, restart = index, start
+            if start >= rel + delete:
+                old_starts[start] = index
+            start += length
+        if skip is None:
+            skip, restart = len(lengths), start
+        resync = len(lengths)
+        new_lengths, new_replaced = [], []
+        for start, end, span, _, _ in self.parser._scan_source(
+                context + new_text, len(context) + restart):
+            pos = start - len(context)
+            if pos >= rel + len(insert) + self.left and pos - delta in old_starts:
+                resync = old_starts[pos - delta]
+                break
+            if not at_end and pos + self.right > len(new_text):
+                return None
+            new_lengths.append(end - start)
+            new_replaced.append(span)
+        blocks = self._make_blocks(new_text,
+                                   lengths[:skip] + new_lengths + lengths[resync:],
+                                   replaced[:skip] + new_replaced + replaced[resync:])
+        return (sum(len(r) for r in replaced[:skip]),
+                ''.join(replaced[skip:resync]), ''.join(new_replaced), blocks)
+
+    def _make_blocks(self, text, lengths, replaced):
+        """Splits spans covering text into blocks of BLOCK_SIZE spans"""
+        blocks = []
+        pos = 0
+        for index in range(0, len(lengths), self.BLOCK_SIZE):
+            block_lengths = lengths[index:index + self.BLOCK_SIZE]
+            size = sum(block_lengths)
+            blocks.append(_SpanBlock(text[pos:pos + size], block_lengths,
+                                     replaced[index:index + self.BLOCK_SIZE]))
+            pos += size
+        return blocks
+
+
+class AvroPipeline():
+    """Streams records through a chain of text stages
+
+    Every record travels between stages as a list of pieces. Stages that
+    work on one piece at a time are composed into a single function, and
+    case fixing followed by transliteration fuses into one parse, so a
+    record is walked once per run of such stages and only joined into a
+    whole string again at the end. segment splits pieces after the
+    whitespace that follows each word, which lets a cache stage memoise
+    the stages after it word by word.
+
+    Usage:
+
+    ::
+    from avrolib import AvroParser, AvroPipeline
+    avro = AvroParser()
+    pipe = AvroPipeline(AvroPipeline.decode(), AvroPipeline.normalise(avro),
+                        AvroPipeline.segment(), AvroPipeline.cache(),
+                        AvroPipeline.transliterate(avro), AvroPipeline.encode())
+    list(pipe([b'ami banglay gan gai']))
+
+    """
+
+    Stage = namedtuple('Stage', ['kind', 'func', 'parser'])
+
+    def __init__(self, *stages):
+        self.stages = stages
+        self.caches = []
+        self._runs = self._fuse(stages)
+
+    def __call__(self, records):
+        """Yields each of records after passing it through every stage"""
+        runs = self._runs
+        for record in records:
+            pieces = [record]
+            for split, func in runs:
+                if split:
+                    pieces = [part for piece in pieces for part in func(piece)]
+                else:
+                    pieces = list(map(func, pieces))
+            yield pieces[0] if len(pieces) == 1 else pieces[0][:0].join(pieces)
+
+    def cache_info(self):
+        """Returns the hits and misses of each cache stage"""
+        return [cached.cache_info() for cached in self.caches]
+
+    @classmethod
+    def decode(cls, encoding='utf-8', errors='strict'):
+        """Stage decoding bytes-like records to text"""
+        return cls.Stage('map', lambda piece: str(piece, encoding, errors), None)
+
+    @classmethod
+    def normalise(cls, parser):
+        """Stage turning text into its canonical form under parser, which
+        fixes case the way parser does before matching"""
+        return cls.Stage('normalise', parser.canonical, parser)
+
+    @classmethod
+    def segment(cls):
+        """Stage splitting pieces into words, each with the whitespace after
+        it, and any whitespace they begin with"""
+        return cls.Stage('segment', cls._split_whitespace, None)
+
+    @classmethod
+    def cache(cls, maxsize=65536):
+        """Stage memoising the stages after it, up to the next segment"""
+        return cls.Stage('cache', maxsize, None)
+
+    @classmethod
+    def transliterate(cls, parser):
+        """Stage parsing each piece with parser"""
+        return cls.Stage('transliterate', parser.parse, parser)
+
+    @classmethod
+    def postprocess(cls, func):
+        """Stage applying func to each piece of text"""
+        return cls.Stage('map', func, None)
+
+    @classmethod
+    def encode(cls, encoding='utf-8', errors='strict'):
+        """Stage encoding text to bytes"""
+        return cls.Stage('map', lambda piece: piece.encode(encoding, errors), None)
+
+    # A suffix rule reads whitespace after a word differently from the end
+    # of text, so a word keeps the whitespace that follows it
+    _whitespace = re.compile(r'\s+|\S+\s*')
+
+    @classmethod
+    def _split_whitespace(cls, piece):
+        return cls._whitespace.findall(piece) or [piece]
+
+    def _fuse(self, stages):
+        """Returns (split, func) runs doing the work of stages"""
+        runs = []
+        funcs = []
+        maxsize = None
+        # Parser whose case fixing the pieces have been through
+        fixed_by = None
+
+        def flush():
+            if funcs:
+                func = self._compose(funcs)
+                if maxsize is not None:
+                    func = lru_cache(maxsize)(func)
+                    self.caches.append(func)
+                runs.append((False, func))
+            del funcs[:]
+
+        for stage in stages:
+            if stage.kind in ('segment', 'cache'):
+                flush()
+                maxsize = None
+                if stage.kind == 'cache':
+                    maxsize = stage.func
+                else:
+                    runs.append((True, stage.func))
+            elif stage.kind == 'transliterate':
+                if not stage.parser._splits_on_whitespace() and \
+                        any(s.kind == 'segment' for s in stages):
+                    raise ValueError('ruleset patterns span whitespace, '
+                                     'so text cannot be segmented')
+                if fixed_by is stage.parser:
+                    funcs.append(stage.parser._parse_fixed)
+                else:
+                    funcs.append(stage.func)
+                fixed_by = None
+            else:
+                funcs.append(stage.func)
+                fixed_by = stage.parser if stage.kind == 'normalise' else None
+        flush()
+        return runs
+
+    @staticmethod
+    def _compose(funcs):
+        """Returns a function applying each of funcs in turn"""
+        if len(funcs) == 1:
+            return funcs[0]
+        funcs = tuple(funcs)
+
+        def composed(piece):
+            for func in funcs:
+                piece = func(piece)
+            return piece
+        return composed
+
+
+class AvroBatchParser():
+    """Parses batches of short strings with NumPy array operations
+
+    Strings of a chunk are packed into a two dimensional array of case
+    fixed character codes. The pattern matching at every position is found
+    with one sorted lookup per pattern length, the greedy left to right
+    choice is made one column at a time for all strings at once, and rules
+    are evaluated as masks over the matched positions. Output is identical
+    to parse. Strings that are not all ASCII, and rulesets that are not,
+    are handed to parse. Needs NumPy.
+
+    Usage:
+
+    ::
+    from avrolib import AvroBatchParser
+    batch = AvroBatchParser()
+    batch.parse_many(['ami', 'banglay', 'gan', 'gai'])
+
+    """
+
+    def __init__(self, parser=None, chunk_size=4096):
+        import numpy as np
+        self.parser = parser if parser is not None else AvroParser()
+        self.chunk_size = chunk_size
+        # Finds are packed eight bytes to an integer and may not hold NUL,
+        # which pads the packed strings
+        self.vectorised = self.parser._encoded_replacements() is not None and \
+            all(0 < len(p['find']) <= 8 and '\x00' not in p['find']
+                for p in self.parser.PATTERNS)
+        if not self.vectorised:
+            return
+        parser = self.parser
+        # Patterns in the order parse tries them
+        ordered = parser.NON_RULE_PATTERNS + parser.RULE_PATTERNS
+        self._patterns = ordered
+        self._lengths = np.array([len(p['find']) for p in ordered] + [1])
+        self._max_find = max(len(p['find']) for p in ordered)
+        self._reach = max(parser._reach()[1], self._max_find) + 1
+        # Rank in ordered of the first pattern for each find, by length
+        self._codes = {}
+        for length in range(1, self._max_find + 1):
+            first = {}
+            for rank, pattern in enumerate(ordered):
+                if len(pattern['find']) == length:
+                    first.setdefault(self._code(pattern['find']), rank)
+            codes = np.array(sorted(first), dtype=np.uint64)
+            self._codes[length] = (codes, np.array([first[c] for c in sorted(first)],
+                                                   dtype=np.int64))
+        # Replacements: pattern defaults, then rules, then passed through codes
+        self._table = [p['replace'] for p in ordered]
+        self._rule_ids = {}
+        for rank, pattern in enumerate(ordered):
+            if 'rules' in pattern:
+                self._rule_ids[rank] = len(self._table)
+                self._table.extend(rule['replace'] for rule in pattern['rules'])
+        self._passed = len(self._table)
+        self._table.extend(chr(code) for code in range(256))
+        self._table = np.array(self._table, dtype=object)
+        self._rule_ranks = np.array(sorted(self._rule_ids), dtype=np.int64)
+        # Lookup tables over character codes
+        chars = [chr(code) for code in range(256)]
+        self._fix = np.array([ord(parser._fix_string_case(c)) for c in chars[:128]],
+                             dtype=np.uint8)
+        self._vowel = np.array([parser._is_vowel(c) for c in chars])
+        self._consonant = np.array([parser._is_consonant(c) for c in chars])
+        self._punctuation = np.array([parser._is_punctuation(c) for c in chars])
+
+    @staticmethod
+    def _code(text):
+        """Packs up to eight character codes into one integer"""
+        code = 0
+        for char in text:
+            code = (code << 8) | ord(char)
+        return code
+
+    def parse_many(self, texts):
+        """Returns the output of parse for each of texts, in order"""
+        texts = list(texts)
+        outputs = [None] * len(texts)
+        if not self.vectorised:
+            return [self.parser.parse(text) for text in texts]
+        packed = []
+        for index, text in enumerate(texts):
+            if text.isascii():
+                packed.append(index)
+            else:
+                outputs[index] = self.parser.parse(text)
+        # Chunks of similar length waste little padding
+        packed.sort(key=lambda index: len(texts[index]))
+        for start in range(0, len(packed), self.chunk_size):
+            chunk = packed[start:start + self.chunk_size]
+            for index, output in zip(chunk, self._parse_chunk([texts[i] for i in chunk])):
+                outputs[index] = output
+        return outputs
+
+    def _parse_chunk(self, texts):
+        import numpy as np
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        width = int(lengths.max()) if len(texts) else 0
+        if width == 0:
+            return [''] * len(texts)
+        rows = len(texts)
+        # Case fixed codes, with zeros past the end of each string
+        data = np.frombuffer(''.join(texts).encode('ascii'), dtype=np.uint8)
+        chars = np.zeros((rows, width + self._reach), dtype=np.uint8)
+        offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        chars[np.repeat(np.arange(rows), lengths),
+              np.arange(len(data)) - offsets] = self._fix[data]
+
+        # Highest ranked pattern matching at each position
+        none = len(self._patterns)
+        best = np.full((rows, width), none, dtype=np.int64)
+        key = np.zeros((rows, width), dtype=np.uint64)
+        for length in range(1, self._max_find + 1):
+            key = (key << np.uint64(8)) | chars[:, length - 1:length - 1 + width]
+            codes, ranks = self._codes[length]
+            if not len(codes):
+                continue
+            found = np.minimum(np.searchsorted(codes, key), len(codes) - 1)
+            best = np.where(codes[found] == key, np.minimum(best, ranks[found]), best)
+
+        # Greedy left to right choice of spans, a column at a time
+        starts = np.zeros((rows, width), dtype=bool)
+        cursor = np.zeros(rows, dtype=np.int64)
+        for column in range(width):
+            active = (cursor == column) & (column < lengths)
+            starts[:, column] = active
+            cursor = np.where(active, column + self._lengths[best[:, column]], cursor)
+        row, col = np.nonzero(starts)
+        rank = best[row, col]
+        ids = np.where(rank < none, rank, self._passed + chars[row, col].astype(np.int64))
+
+        # Rules of rule patterns, the first one that fires wins
+        for pattern_rank in np.intersect1d(np.unique(rank), self._rule_ranks):
+            at = np.nonzero(rank == pattern_rank)[0]
+            fired = self._fire(self._patterns[pattern_rank], chars, lengths,
+                               row[at], col[at])
+            hit = fired >= 0
+            ids[at[hit]] = self._rule_ids[pattern_rank] + fired[hit]
+
+        # Join each row's replacements
+        pieces = self._table[ids].tolist()
+        ends = np.cumsum(starts.sum(axis=1)).tolist()
+        outputs = []
+        begin = 0
+        for end in ends:
+            outputs.append(''.join(pieces[begin:end]))
+            begin = end
+        return outputs
+
+    def _fire(self, pattern, chars, lengths, row, cur):
+        """Returns the index of the rule of pattern that fires at each of the
+        (row, cur) positions, or -1 where none does"""
+        import numpy as np
+        fired = np.full(len(row), -1, dtype=np.int64)
+        cur_end = cur + len(pattern['find'])
+        length = lengths[row]
+        for index, rule in enumerate(pattern['rules']):
+            if not rule['matches']:
+                continue
+            matched = fired < 0
+            for match in rule['matches']:
+                matched &= self._match(match, chars, length, row, cur, cur_end)
+            fired[matched] = index
+        return fired
+
+    def _match(self, match, chars, length, row, cur, cur_end):
+        """Evaluates a single match of a rule as _process_match does"""
+        import numpy as np
+        prefix = match['type'] == 'prefix'
+        chk = cur - 1 if prefix else cur_end
+        negative = match['scope'].startswith('!')
+        scope = match['scope'][1:] if negative else match['scope']
+        at = chars[row, np.maximum(chk, 0)]
+        if scope == 'punctuation':
+            if prefix:
+                result = (chk < 0) | self._punctuation[at]
+            else:
+                result = (chk >= length) | self._punctuation[at]
+        elif scope in ('vowel', 'consonant'):
+            table = self._vowel if scope == 'vowel' else self._consonant
+            if prefix:
+                result = (chk >= 0) & table[at]
+            else:
+                result = (chk < length) & table[at]
+        elif scope == 'exact':
+            value = match['value']
+            if prefix:
+                start, end = cur - len(value), cur
+            else:
+                start, end = cur_end, cur_end + len(value)
+            result = (start >= 0) & (end < length)
+            for offset, char in enumerate(value):
+                result &= chars[row, np.maximum(start + offset, 0)] == ord(char)
+        else:
+            return np.ones(len(row), dtype=bool)
+        return result ^ negative
+
+
+class AvroLiveParser():
+    """Parses with a ruleset that can be reloaded while in use
+
+    reload() compiles the new ruleset with AvroParser.from_ruleset in a
+    background thread, then swaps it in with a single assignment. Calls
+    already running finish with the parser they started with and no call
+    ever waits for a reload. If the new ruleset fails to load, the old one
+    stays in use and the error is kept in self.error.
+
+    Sessions, documents, pipelines and other helpers take a plain parser;
+    pass them self.parser to use the current ruleset from then on.
+
+    Usage:
+
+    ::
+    from avrolib import AvroLiveParser
+    avro = AvroLiveParser('rules.json')
+    avro.parse("ami banglay gan gai")
+    avro.reload()
+
+    """
+
+    def __init__(self, ruleset):
+        self.ruleset = ruleset
+        self.parser = AvroParser.from_ruleset(ruleset)
+        self.error = None
+        # Serialises reloads; parsing never takes it
+        self._lock = threading.Lock()
+
+    def parse(self, text, with_spans=False, with_tokens=False):
+        return self.parser.parse(text, with_spans, with_tokens)
+
+    def parse_markup(self, text, protect=None):
+        return self.parser.parse_markup(text, protect)
+
+    def parse_bytes(self, buf):
+        return self.parser.parse_bytes(buf)
+
+    def reload(self, ruleset=None, wait=False):
+        """Loads ruleset, or the last ruleset given again, and swaps it in
+
+        Loads in a background thread and returns it, unless wait is True,
+        in which case it loads in this thread and raises any error.
+        """
+        if ruleset is None:
+            ruleset = self.ruleset
+        if wait:
+            self._reload(ruleset, raise_error=True)
+            return None
+        thread = threading.Thread(target=self._reload, args=(ruleset,),
+                                  name='avro-reload', daemon=True)
+        thread.start()
+        return thread
+
+    def _reload(self, ruleset, raise_error=False):
+        with self._lock:
+            try:
+                parser = AvroParser.from_ruleset(ruleset)
+            except (OSError, ValueError) as error:
+                self.error = error
+                if raise_error:
+                    raise
+                return
+            self.ruleset = ruleset
+            self.parser = parser
+            self.error = None
+
+
+class AvroMetrics():
+    """Collects parser latency and throughput for Prometheus
+
+    observe(parser) makes parser record each parse, parse_markup and
+    parse_bytes call, including those made for it by pipelines and the
+    column and file helpers: its latency in a histogram labelled by method
+    and input length bucket, and counters of calls and of characters in
+    and out (bytes, for parse_bytes). Sessions and documents reparse a few
+    characters per edit without calling these and are not recorded.
+    observe_cache adds the hits and misses of anything with a cache_info()
+    method, such as an AvroPipeline or the function register_sqlite_function
+    returns. render() gives it all in the Prometheus text exposition format.
+
+    Observe a parser before handing it to pipelines or caches, which hold
+    on to its methods. Like profiling, observing shadows the parser's
+    methods on the instance, and parsers that are not observed are not
+    slowed at all.
+
+    Usage:
+
+    ::
+    from avrolib import AvroMetrics, AvroParser
+    metrics = AvroMetrics()
+    avro = metrics.observe(AvroParser())
+    avro.parse("ami banglay gan gai")
+    print(metrics.render())
+
+    """
+
+    LATENCY_BUCKETS = (.00001, .000025, .00005, .0001, .00025, .0005, .001,
+                       .0025, .005, .01, .025, .05, .1, .25, 1.)
+    LENGTH_BUCKETS = (16, 64, 256, 1024, 4096, 16384)
+
+    # Parser methods shadowed by observe, each counted as the public method
+    _OBSERVED = ('parse', '_parse_fixed', 'parse_markup', 'parse_bytes')
+
+    def __init__(self, prefix='avro', latency_buckets=None, length_buckets=None):
+        self.prefix = prefix
+        self.latency_buckets = tuple(latency_buckets or self.LATENCY_BUCKETS)
+        self.length_buckets = tuple(length_buckets or self.LENGTH_BUCKETS)
+        self._lock = threading.Lock()
+        # (method, length bucket) -> count per latency bucket, then +Inf
+        # count and the sum of seconds
+        self._histograms = {}
+        self._calls = Counter()
+        self._characters_in = Counter()
+        self._characters_out = Counter()
+        self._caches = {}
+
+    def observe(self, parser):
+        """Records calls to parser from now on, and returns parser
+
+        Methods parser already has shadowed, as by AvroSlowLog.observe, are
+        recorded in turn, so both see every call.
+        """
+        cls = type(parser)
+        record = self._record
+        clock = time.perf_counter
+        # Calls a parser makes to itself are part of the outer call
+        local = threading.local()
+
+        def timed(method, func):
+            def observed(text, *args, **kwargs):
+                if getattr(local, 'busy', False):
+                    return func(text, *args, **kwargs)
+                local.busy = True
+                start = clock()
+                try:
+                    result = func(text, *args, **kwargs)
+                finally:
+                    local.busy = False
+                seconds = clock() - start
+                output = result[0] if isinstance(result, tuple) else result
+                record(method, len(text), len(output), seconds)
+                return result
+            return observed
+
+        for name in self._OBSERVED:
+            func = parser.__dict__.get(name)
+            if func is None:
+                func = getattr(cls, name).__get__(parser)
+            parser.__dict__[name] = timed(name.lstrip('_').replace('_fixed', ''), func)
+        return parser
+
+    def observe_cache(self, name, cache):
+        """Reports the hits and misses of cache.cache_info() as cache name"""
+        self._caches[name] = cache
+
+    def _record(self, method, characters_in, characters_out, seconds):
+        key = (method, bisect_left(self.length_buckets, characters_in))
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = \
+                    [0] * (len(self.latency_buckets) + 1) + [0.]
+            counts[bisect_left(self.latency_buckets, seconds)] += 1
+            counts[-1] += seconds
+            self._calls[method] += 1
+            self._characters_in[method] += characters_in
+            self._characters_out[method] += characters_out
+
+    def render(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        prefix = self.prefix
+        lengths = [str(bound) for bound in self.length_buckets] + ['+Inf']
+        bounds = [repr(float(bound)) for bound in self.latency_buckets] + ['+Inf']
+        with self._lock:
+            histograms = dict((key, list(counts))
+                              for key, counts in self._histograms.items())
+            counters = [(name, dict(counter)) for name, counter in (
+                ('calls', self._calls),
+                ('input_characters', self._characters_in),
+                ('output_characters', self._characters_out))]
+        lines = [
+            '# HELP %s_call_duration_seconds Parse call latency by input length'
+            % prefix,
+            '# TYPE %s_call_duration_seconds histogram' % prefix,
+        ]
+        for (method, length), counts in sorted(histograms.items()):
+            labels = 'method="%s",length="%s"' % (method, lengths[length])
+            total = 0
+            for bound, count in zip(bounds, counts):
+                total += count
+                lines.append('%s_call_duration_seconds_bucket{%s,le="%s"} %d'
+                             % (prefix, labels, bound, total))
+            lines.append('%s_call_duration_seconds_sum{%s} %r'
+                         % (prefix, labels, counts[-1]))
+            lines.append('%s_call_duration_seconds_count{%s} %d'
+                         % (prefix, labels, total))
+        helps = {
+            'calls': 'Parse calls',
+            'input_characters': 'Characters (bytes for parse_bytes) parsed',
+            'output_characters': 'Characters (bytes for parse_bytes) produced',
+        }
+        for name, counter in counters:
+            lines.append('# HELP %s_%s_total %s' % (prefix, name, helps[name]))
+            lines.append('# TYPE %s_%s_total counter' % (prefix, name))
+            for method, value in sorted(counter.items()):
+                lines.append('%s_%s_total{method="%s"} %d' % (prefix, name, method, value))
+        caches = []
+        for name, cache in sorted(self._caches.items()):
+            infos = cache.cache_info()
+            if not isinstance(infos, list):
+                infos = [infos]
+            caches.append((self._escape(name), sum(info.hits for info in infos),
+                           sum(info.misses for info in infos)))
+        for kind in ('hits', 'misses'):
+            lines.append('# HELP %s_cache_%s_total Cache %s' % (prefix, kind, kind))
+            lines.append('# TYPE %s_cache_%s_total counter' % (prefix, kind))
+            for name, hits, misses in caches:
+                lines.append('%s_cache_%s_total{cache="%s"} %d'
+                             % (prefix, kind, name, hits if kind == 'hits' else misses))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _escape(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class AvroSlowLog():
+    """Records what made slow parser calls slow, without keeping the text
+
+    observe(parser) makes parser time each parse, parse_markup and
+    parse_bytes call. A call taking longer than budget seconds, plus
+    per_char seconds for each character of its input, is kept with
+    probability sample and at most limit times every interval seconds,
+    and recorded as a dict of:
+
+    - "method", "seconds" and "budget": the call, its time and its limit
+    - "length" and "classes": the input's length and how many of its
+      characters are vowels, consonants, digits, "space", "punctuation"
+      and "other" (anything beyond ASCII)
+    - "hash": a keyed BLAKE2 digest of the input, equal for equal inputs
+
+    If replay is True, a kept call is also run again on a profiled copy
+    of the parser in a background thread, after the caller has its
+    result, and its record has in addition:
+
+    - "phases": seconds spent case fixing, matching and evaluating rules
+      in the run again
+    - "spans", "replacements", "rule_evaluations" and
+      "clause_evaluations": the work it did, as counted by profile_stats
+
+    One call at a time is run again, and calls kept meanwhile are recorded
+    without it. Records go to log, if given, from the thread that made the
+    record, and the keep most recent stay in records(). Calls under their
+    budget only pay for reading the clock twice.
+
+    Usage:
+
+    ::
+    from avrolib import AvroParser, AvroSlowLog
+    slow = AvroSlowLog(budget=0.005, per_char=0.00001, log=print)
+    avro = slow.observe(AvroParser())
+    avro.parse("ami banglay gan gai")
+    slow.records()
+
+    """
+
+    def __init__(self, budget=0.01, per_char=0., sample=1., limit=10,
+                 interval=60., keep=100, log=None, key=b'', replay=False):
+        self.budget = budget
+        self.per_char = per_char
+        self.sample = sample
+        self.limit = limit
+        self.interval = interval
+        self.log = log
+        self.key = key
+        self.replay = replay
+        self.suppressed = 0
+        self._records = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self._window = (0., 0)
+
+    def observe(self, parser):
+        """Watches calls to parser from now on, and returns parser
+
+        Methods parser already has shadowed, as by AvroMetrics.observe, are
+        watched in turn, so both see every call.
+        """
+        cls = type(parser)
+        clock = time.perf_counter
+        local = threading.local()
+        probe = []
+
+        def watched(name, func):
+            def call(text, *args, **kwargs):
+                if getattr(local, 'busy', False):
+                    return func(text, *args, **kwargs)
+                local.busy = True
+                start = clock()
+                try:
+                    result = func(text, *args, **kwargs)
+                finally:
+                    local.busy = False
+                seconds = clock() - start
+                budget = self.budget + self.per_char * len(text)
+                if seconds > budget and self._admit():
+                    self._slow(parser, probe, name, text, args, kwargs, seconds, budget)
+                return result
+            return call
+
+        for name in AvroMetrics._OBSERVED:
+            func = parser.__dict__.get(name)
+            if func is None:
+                func = getattr(cls, name).__get__(parser)
+            parser.__dict__[name] = watched(name, func)
+        return parser
+
+    def records(self):
+        """Returns the most recent records, oldest first"""
+        with self._lock:
+            return list(self._records)
+
+    def _admit(self):
+        """Returns whether a slow call is sampled and within the rate limit"""
+        if self.sample < 1 and random.random() >= self.sample:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            start, count = self._window
+            if now - start >= self.interval:
+                start, count = now, 0
+            if count >= self.limit:
+                self.suppressed += 1
+                return False
+            self._window = (start, count + 1)
+        return True
+
+    def _slow(self, parser, probe, name, text, args, kwargs, seconds, budget):
+        record = dict(method=name.lstrip('_').replace('_fixed', ''),
+                      seconds=seconds, budget=budget)
+        record.update(self.fingerprint(parser, text))
+        if not self.replay:
+            self._keep(record)
+            return
+        if not probe:
+            # A copy without any shadowing, sharing the parser's tables
+            copy = type(parser).__new__(type(parser))
+            copy.__dict__.update(parser.__dict__)
+            for shadowed in parser._PROFILED + AvroMetrics._OBSERVED + ('_profile',):
+                copy.__dict__.pop(shadowed, None)
+            probe.append((copy, threading.Lock()))
+        copy, lock = probe[0]
+        # One call at a time runs again, and others skip it
+        if not lock.acquire(False):
+            self._keep(record)
+            return
+        if not isinstance(text, str):
+            # The caller may change a bytearray once it has its result
+            text = bytes(text)
+        threading.Thread(target=self._replay, name='avro-slow-replay', daemon=True,
+                         args=(copy, lock, name, text, args, kwargs, record)).start()
+
+    def _replay(self, copy, lock, name, text, args, kwargs, record):
+        """Runs a kept call again on the profiled copy and records the
+        work it did"""
+        try:
+            copy.profile()
+            getattr(copy, name)(text, *args, **kwargs)
+            stats = copy.profile_stats()
+            copy.profile(False)
+        finally:
+            lock.release()
+        record.update(phases=stats['seconds'],
+                      spans=sum(stats['replacements'].values()),
+                      replacements=stats['replacements'],
+                      rule_evaluations=stats['rule_evaluations'],
+                      clause_evaluations=stats['clause_evaluations'])
+        self._keep(record)
+
+    def _keep(self, record):
+        """Stores record and passes it to log"""
+        with self._lock:
+            self._records.append(record)
+        if self.log is not None:
+            self.log(record)
+
+    def fingerprint(self, parser, text):
+        """Returns the length, character classes and hash of text"""
+        import hashlib
+        length = len(text)
+        if isinstance(text, str):
+            data = text.encode('utf-8', 'surrogatepass')
+        else:
+            data = bytes(text)
+            text = data.decode('utf-8', 'replace')
+        classes = Counter()
+        for char in text:
+            if char.isspace():
+                classes['space'] += 1
+            elif not char.isascii():
+                classes['other'] += 1
+            elif parser._is_vowel(char):
+                classes['vowel'] += 1
+            elif parser._is_consonant(char):
+                classes['consonant'] += 1
+            elif char.isdigit():
+                classes['digit'] += 1
+            else:
+                classes['punctuation'] += 1
+        return dict(length=length, classes=dict(classes),
+                    hash=hashlib.blake2b(data, digest_size=8, key=self.key).hexdigest())
+
+
+# Parser of the current worker process, set up by _init_worker
+_worker_parser = None
+
+
+def _init_worker(parser):
+    global _worker_parser
+    _worker_parser = parser
+
+
+def _parse_chunk(texts):
+    return [_worker_parser.parse(text) for text in texts]
+
+
+@lru_cache(maxsize=None)
+def _default_parser():
+    """Returns the parser shared by helpers that are not given one"""
+    return AvroParser()
+
+
+def _worker_pool(parser, workers):
+    """Returns a process pool whose workers each hold a copy of parser"""
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(workers, initializer=_init_worker,
+                               initargs=(parser,))
+
+
+def _parse_all(texts, parser=None, workers=None, chunksize=1024, executor=None):
+    """Parses each of texts, in workers processes if more than one
+
+    An executor from _worker_pool may be passed to reuse its processes.
+    Returns the outputs in the order of texts.
+    """
+    if parser is None:
+        parser = _default_parser()
+    if executor is None and (not workers or workers == 1) or len(texts) <= chunksize:
+        return [parser.parse(text) for text in texts]
+    chunks = [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+    if executor is not None:
+        return [out for outs in executor.map(_parse_chunk, chunks) for out in outs]
+    with _worker_pool(parser, workers) as executor:
+        return [out for outs in executor.map(_parse_chunk, chunks) for out in outs]
+
+
+def transliterate_series(series, parser=None, workers=None):
+    """Transliterates a pandas Series of Roman strings
+
+    Each distinct value is parsed once, in workers processes if more than
+    one, and the results are scattered back by the factorized codes. Nulls
+    are kept as they were. Needs pandas.
+
+    Usage:
+
+    ::
+    import pandas as pd
+    from avrolib import transliterate_series
+    transliterate_series(pd.Series(['ami', None, 'ami']))
+
+    """
+    import numpy as np
+    import pandas as pd
+    codes, uniques = pd.factorize(series)
+    values = np.empty(len(uniques) + 1, dtype=object)
+    values[:-1] = _parse_all(list(uniques), parser, workers)
+    # Code -1 marks nulls and takes the trailing slot, where the original
+    # objects are scattered back so that None, NaN and NA stay apart
+    output = values.take(codes)
+    nulls = codes == -1
+    if nulls.any():
+        output[nulls] = series.to_numpy(dtype=object)[nulls]
+    result = pd.Series(output, index=series.index, name=series.name, dtype=object)
+    if isinstance(series.dtype, pd.StringDtype):
+        result = result.astype(series.dtype)
+    return result
+
+
+def transliterate_arrow(array, parser=None, workers=None):
+    """Transliterates an Arrow string Array or ChunkedArray
+
+    Distinct values are parsed once, as for transliterate_series, and taken
+    back into place by their index among them. Nulls stay null. Needs
+    pyarrow.
+
+    Usage:
+
+    ::
+    import pyarrow as pa
+    from avrolib import transliterate_arrow
+    transliterate_arrow(pa.array(['ami', None, 'ami']))
+
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    uniques = pc.drop_null(pc.unique(array))
+    values = pa.array(_parse_all(uniques.to_pylist(), parser, workers),
+                      type=array.type)
+    return pc.take(values, pc.index_in(array, value_set=uniques))
+
+
+def register_sqlite_function(connection, name='avro', parser=None, maxsize=65536):
+    """Registers name(text) as a deterministic SQLite function transliterating
+    text on connection
+
+    Calls go through an LRU cache of maxsize entries in front of parser, or
+    of one parser shared by all connections if none is given, keyed by the
+    canonical form of the text so that spellings parsing alike share an
+    entry. NULL stays NULL. Returns the cached function, whose cache_info()
+    reports hits and misses.
+
+    Usage:
+
+    ::
+    import sqlite3
+    from avrolib import register_sqlite_function
+    db = sqlite3.connect('words.db')
+    register_sqlite_function(db)
+    db.execute('UPDATE words SET bn = avro(roman)')
+
+    """
+    if parser is None:
+        parser = _default_parser()
+    cached = lru_cache(maxsize)(parser._parse_fixed)
+    canonical = parser.canonical
+
+    def avro(text):
+        if text is None:
+            return None
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        return cached(canonical(str(text)))
+    avro.cache_info = cached.cache_info
+    avro.cache_clear = cached.cache_clear
+    connection.create_function(name, 1, avro, deterministic=True)
+    return avro
+
+
+def transliterate_file(infile, outfile, fields, format='jsonl', parser=None,
+                       workers=None, batch_size=10000, cache_size=100000):
+    """Copies JSON Lines or CSV records from infile to outfile, transliterating
+    the string values of fields
+
+    Records are read batch_size at a time. The distinct canonical forms of
+    the values of a batch that have not been seen recently are parsed
+    together, in workers processes if more than one, and the batch is
+    written back in its original order. Memory stays bounded by the batch
+    and by the cache_size most recent values kept for reuse across batches.
+
+    Returns a dictionary of counts and timings of the run: "records",
+    "values", "parsed", "chars" and "seconds", plus "records_per_second"
+    and "chars_per_second". Raises ValueError, before writing anything,
+    if format is unknown or fields are missing from the CSV header.
+
+    Usage:
+
+    ::
+    from avrolib import transliterate_file
+    with open('in.jsonl') as src, open('out.jsonl', 'w') as dst:
+        transliterate_file(src, dst, ['title', 'body'])
+
+    """
+    if format not in ('jsonl', 'csv'):
+        raise ValueError('format must be jsonl or csv, not %r' % (format,))
+    if parser is None:
+        parser = _default_parser()
+    fields = list(fields)
+    reader, writer = (_jsonl_io if format == 'jsonl' else _csv_io)(infile, outfile, fields)
+    stats = dict(records=0, values=0, parsed=0, chars=0)
+    cache = {}
+    executor = _worker_pool(parser, workers) if workers and workers > 1 else None
+    start = time.perf_counter()
+    try:
+        while True:
+            batch = list(islice(reader, batch_size))
+            if not batch:
+                break
+            values = [value for _, slots in batch for _, value in slots]
+            # Values parsing alike share their canonical key in the cache
+            keys = dict((value, parser.canonical(value)) for value in values)
+            pending = list(dict.fromkeys(k for k in keys.values() if k not in cache))
+            for text, output in zip(pending, _parse_all(pending, parser,
+                                                        executor=executor)):
+                cache[text] = output
+            for record, slots in batch:
+                writer(record, [(slot, cache[keys[value]]) for slot, value in slots])
+            # Forget the oldest values once the cache outgrows its bound
+            for text in list(islice(cache, max(0, len(cache) - cache_size))):
+                del cache[text]
+            stats['records'] += len(batch)
+            stats['values'] += len(values)
+            stats['parsed'] += len(pending)
+            stats['chars'] += sum(len(v) for v in values)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    stats['seconds'] = elapsed = time.perf_counter() - start
+    stats['records_per_second'] = stats['records'] / elapsed if elapsed else 0.0
+    stats['chars_per_second'] = stats['chars'] / elapsed if elapsed else 0.0
+    return stats
+
+
+def _jsonl_io(infile, outfile, fields):
+    """Returns a reader of (record, [(field, value)]) pairs from JSON Lines,
+    and a writer putting new values into a record and writing it out"""
+    import json
+
+    def reader():
+        for line in infile:
+            if not line.strip():
+                yield line, []
+                continue
+            record = json.loads(line)
+            yield record, [(field, record[field]) for field in fields
+                           if isinstance(record.get(field), str)]
+
+    def writer(record, slots):
+        if isinstance(record, str):
+            outfile.write(record)
+            return
+        for field, value in slots:
+            record[field] = value
+        outfile.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return reader(), writer
+
+
+def _csv_io(infile, outfile, fields):
+    """Returns a reader and writer like _jsonl_io for CSV with a header row"""
+    import csv
+    rows = csv.reader(infile)
+    out = csv.writer(outfile)
+    header = next(rows, None)
+    if header is None:
+        return iter(()), None
+    missing = _missing_fields(header, fields)
+    if missing:
+        raise ValueError(missing)
+    out.writerow(header)
+    columns = [header.index(field) for field in fields]
+
+    def reader():
+        for row in rows:
+            yield row, [(column, row[column]) for column in columns
+                        if column < len(row)]
+
+    def writer(row, slots):
+        for column, value in slots:
+            row[column] = value
+        out.writerow(row)
+    return reader(), writer
+
+
+def _missing_fields(header, fields):
+    """Returns a message naming fields not in a CSV header, or None"""
+    missing = [field for field in fields if field not in header]
+    if missing:
+        return 'fields not in CSV header: %s' % ', '.join(missing)
+    return None
+
+
+def _csv_header(infile):
+    """Returns the header row of CSV infile, or None if it is empty, and
+    an iterator of infile's lines from the start again"""
+    import csv
+    lines = iter(infile)
+    read = []
+
+    def recorded():
+        for line in lines:
+            read.append(line)
+            yield line
+    # The reader takes only the lines of the header, which may be several
+    header = next(csv.reader(recorded()), None)
+    return header, chain(read, lines)
+
+
+def _describe_analysis(parser):
+    """Returns the findings of parser.analyse() for ruleset authors"""
+    analysis = parser.analyse()
+    patterns = parser.PATTERNS
+
+    def name(index):
+        return '%r (pattern %d)' % (patterns[index]['find'], index)
+    lines = ['%d patterns; longest find %d; rules read up to %d characters before '
+             'and up to %d from the start of a match'
+             % ((len(patterns), analysis.max_find) + analysis.context)]
+    for index in analysis.unmatchable:
+        lines.append('unmatchable: %s, case fixing changes its find' % name(index))
+    for index, by in analysis.shadowed:
+        lines.append('shadowed: %s by %s' % (name(index), name(by)))
+    for index, rule, by in analysis.unreachable_rules:
+        lines.append('unreachable: rule %d of %s, %s' % (
+            rule, name(index), 'covered by rule %s' % ', '.join(map(str, by))
+            if by else 'its matches never hold together'))
+    for index, rule, position in analysis.redundant_clauses:
+        match = patterns[index]['rules'][rule]['matches'][position]
+        lines.append('redundant: match %d (%s %s%s) of rule %d of %s' % (
+            position, match['type'], match['scope'],
+            ' %r' % match['value'] if 'value' in match else '', rule, name(index)))
+    for index in analysis.unanalysed:
+        lines.append('not analysed: rules of %s, which would take more than %d '
+                     'checks; all are kept' % (name(index), parser.RULE_CHECKS))
+    return '\n'.join(lines) + '\n'
+
+
+def main(argv=None):
+    """Command line entry point transliterating fields of JSONL or CSV files"""
+    import argparse
+    import io
+    import sys
+    ap = argparse.ArgumentParser(
+        prog='avrolib', description='Transliterate fields of JSON Lines or '
+        'CSV records from Roman to Bengali script.')
+    ap.add_argument('input', nargs='?', help="input file, or - for standard input")
+    ap.add_argument('output', nargs='?', help="output file, or - for standard output")
+    ap.add_argument('-f', '--field', action='append',
+                    help='field to transliterate; may be given more than once')
+    ap.add_argument('--format', choices=['jsonl', 'csv'],
+                    help='record format; guessed from the input name if not given')
+    ap.add_argument('-w', '--workers', type=int, default=1)
+    ap.add_argument('--batch-size', type=int, default=10000)
+    ap.add_argument('--analyse', action='store_true',
+                    help='report patterns and rules of the ruleset that can '
+                    'never make a difference, and exit')
+    args = ap.parse_args(argv)
+
+    if args.analyse:
+        sys.stdout.write(_describe_analysis(_default_parser()))
+        return
+    if args.input is None or args.output is None or not args.field:
+        ap.error('input, output and at least one --field are required')
+
+    format = args.format or ('csv' if args.input.endswith('.csv') else 'jsonl')
+    newline = '' if format == 'csv' else None
+    if args.input == '-':
+        infile = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8', newline=newline)
+    else:
+        infile = open(args.input, encoding='utf-8', newline=newline)
+    source = infile
+    if format == 'csv':
+        # Fields missing from the header are reported before the output
+        # file is opened, and truncated
+        header, source = _csv_header(infile)
+        missing = header is not None and _missing_fields(header, args.field)
+        if missing:
+            infile.close()
+            ap.error(missing)
+    if args.output == '-':
+        outfile = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', newline=newline)
+    else:
+        outfile = open(args.output, 'w', encoding='utf-8', newline=newline)
+    with infile, outfile:
+        stats = transliterate_file(source, outfile, args.field, format,
+                                   workers=args.workers,
+                                   batch_size=args.batch_size)
+    sys.stderr.write('%(records)d records, %(values)d values, %(parsed)d parsed '
+                     'in %(seconds).2fs: %(records_per_second).0f records/s, '
+                     '%(chars_per_second).0f chars/s\n' % stats)
+
+
+if __name__ == '__main__':
+    main()
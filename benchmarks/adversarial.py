@@ -0,0 +1,237 @@
+"""Searches for input that makes parse slow per character, and checks
+that parse time stays linear in input length
+
+Candidates are short units repeated to a fixed length. They start from
+families built out of the ruleset itself: runs of vowels whose rules look
+at their neighbours, proper prefixes of long finds that keep almost
+matching, finds next to the exact values their rules compare with, and
+mixed scripts with digits, backticks, joiners and combining marks. A
+seeded mutation search then swaps, inserts and drops tokens of the worst
+units for --seconds, keeping whatever is slower per character.
+
+The worst units found, and the worst of each family, are then timed at
+lengths doubling from --length, each against as many texts of --length
+characters. Fitting the log of that ratio against log length gives the
+growth exponent, and the check fails, exiting with status 1, if any
+exponent is above --max-exponent or time per character at the longest
+length is more than --max-growth times that at the shortest. --max-ratio,
+if given, also bounds the worst time per character as a multiple of the
+time per character of ordinary chat text. The same check is run for
+parse_markup over units that keep almost being markup: dotted runs
+before an "@" that never comes, comments and code blocks that are never
+closed, and tags, links and entities cut short.
+
+Usage:
+
+::
+python benchmarks/adversarial.py
+python benchmarks/adversarial.py --seconds 120 --length 2000 --doublings 5
+
+"""
+import argparse
+import gc
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from avrolib import AvroParser
+from corpus import make_mix
+
+
+def tokens(parser):
+    """Returns the pieces candidates are made of: every find, every exact
+    match value and every single character the ruleset knows"""
+    found = set()
+    for pattern in parser.PATTERNS:
+        found.add(pattern['find'])
+        found.update(pattern['find'])
+        for rule in pattern.get('rules', ()):
+            for match in rule['matches']:
+                if match.get('value'):
+                    found.add(match['value'])
+    found.update(' .,!?0123456789`')
+    return sorted(found)
+
+
+def families(parser):
+    """Returns a dict of family name to the seed units of that family"""
+    vowels = sorted(set(parser.VOWELS))
+    ruled = [p['find'] for p in parser.RULE_PATTERNS]
+    longest = sorted((p['find'] for p in parser.PATTERNS), key=len, reverse=True)
+    exact = [(p['find'], match['value']) for p in parser.RULE_PATTERNS
+             for rule in p['rules'] for match in rule['matches'] if match.get('value')]
+    return {
+        'vowels': [''.join(vowels), ''.join(v.upper() for v in vowels), 'a', 'o',
+                   'oo', 'OI', 'ou', 'aaaa', 'ioioi'] +
+                  [''.join(ruled[i:i + 4]) for i in range(0, len(ruled), 4)],
+        'prefixes': [find[:-1] for find in longest[:40] if len(find) > 2] +
+                    [find[:-1] + ' ' for find in longest[:20] if len(find) > 2],
+        'exact': [value + find for find, value in exact] +
+                 [find + value for find, value in exact] +
+                 [value + find + value for find, value in exact[:40]],
+        'mixed': ['আমিami', 'a\u200dk\u200ch', 'k\u09cdsh', '১২3৪', 'a`o`i``',
+                  't``a', '\U0001F600a\u0301', 'o\u0308e\u0301', 'ক্ষkkh',
+                  '\ufeffa o', 'ÀÉÎÕÜ', '\u0130\u0131\u00df'],
+    }
+
+
+# Units parse_markup is checked against, each almost some kind of markup
+MARKUP_UNITS = ['a.', 'a.b-c+', 'a.@', 'a@b', '<!--', '<!-- -', '<a', '</', '```',
+                '`a', 'http://a.', 'www.', '&amp', '&#x', '\\']
+
+
+def per_char(parser, unit, length, repeat=3, method='parse'):
+    """Returns the least seconds per character of parsing unit repeated to
+    length over repeat runs, with garbage collection off as timeit has it"""
+    text = (unit * (length // len(unit) + 1))[:length]
+    parse = getattr(parser, method)
+    best = float('inf')
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parse(text)
+            best = min(best, time.perf_counter() - start)
+    finally:
+        if collecting:
+            gc.enable()
+    return best / length
+
+
+def mutate(rng, unit, pieces):
+    """Returns unit with a token swapped in, inserted or dropped"""
+    at = rng.randrange(len(unit) + 1)
+    choice = rng.random()
+    if choice < 0.4 or len(unit) < 2:
+        unit = unit[:at] + rng.choice(pieces) + unit[at:]
+    elif choice < 0.8:
+        end = min(len(unit), at + rng.randint(1, 3))
+        unit = unit[:at] + rng.choice(pieces) + unit[end:]
+    else:
+        end = min(len(unit), at + rng.randint(1, 3))
+        unit = unit[:at] + unit[end:] or unit
+    return unit[:24]
+
+
+def search(parser, seeds, pieces, length, seconds, rng, keep=8):
+    """Returns the units slowest per character found within seconds, as
+    (seconds per character, unit) pairs, slowest first"""
+    scored = dict((unit, per_char(parser, unit, length)) for unit in seeds if unit)
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        best = sorted(scored, key=scored.get, reverse=True)[:keep]
+        unit = mutate(rng, rng.choice(best), pieces)
+        if unit and unit not in scored:
+            scored[unit] = per_char(parser, unit, length)
+    return sorted(((cost, unit) for unit, cost in scored.items()), reverse=True)
+
+
+def growth(parser, unit, length, doublings, rounds, method='parse'):
+    """Returns the lengths, seconds per character at each and the fitted
+    exponent of time against length
+
+    Each longer text is timed back to back with the same characters parsed
+    as texts of the shortest length, and the median of their ratio over
+    rounds is kept, so the machine getting slower or faster in between
+    cancels out. Linear time gives ratios of 1 and an exponent of 1.
+    """
+    lengths = [length * 2 ** i for i in range(doublings + 1)]
+    base = [per_char(parser, unit, length, method=method) for _ in range(rounds)]
+    costs = [statistics.median(base)]
+    ratios = [1.]
+    for size in lengths[1:]:
+        measured = []
+        for _ in range(rounds):
+            long = per_char(parser, unit, size, repeat=1, method=method)
+            short = sum(per_char(parser, unit, length, repeat=1, method=method)
+                        for _ in range(size // length)) / (size // length)
+            measured.append((long / short, long))
+        ratio = statistics.median(ratio for ratio, _ in measured)
+        ratios.append(ratio)
+        costs.append(costs[0] * ratio)
+    xs = [math.log(size / length) for size in lengths]
+    ys = [math.log(ratio) for ratio in ratios]
+    exponent = 1 + sum(x * y for x, y in zip(xs, ys)) / sum(x * x for x in xs)
+    return lengths, costs, exponent
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--seconds', type=float, default=30,
+                    help='time spent mutating the worst units')
+    ap.add_argument('--length', type=int, default=1000,
+                    help='characters per candidate, and the shortest checked')
+    ap.add_argument('--doublings', type=int, default=4,
+                    help='times the length is doubled in the linearity check')
+    ap.add_argument('--rounds', type=int, default=5,
+                    help='rounds of timing every length in the linearity check')
+    ap.add_argument('--check', type=int, default=5,
+                    help='slowest units found to check, besides each family\'s worst')
+    ap.add_argument('--max-exponent', type=float, default=1.15)
+    ap.add_argument('--max-growth', type=float, default=1.5)
+    ap.add_argument('--max-ratio', type=float, default=None)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--output', help='write the findings as JSON here')
+    args = ap.parse_args()
+
+    parser = AvroParser()
+    rng = random.Random(args.seed)
+    pieces = tokens(parser)
+    chat = ''.join(make_mix('chat', random.Random(args.seed), args.length * 4))
+    baselines = dict((method, per_char(parser, chat, len(chat), method=method))
+                     for method in ('parse', 'parse_markup'))
+    baseline = baselines['parse']
+    print('chat text %.3f us/char' % (baseline * 1e6))
+
+    worst = {}
+    seeds = []
+    for name, units in families(parser).items():
+        ranked = sorted(((per_char(parser, unit, args.length), unit)
+                         for unit in units if unit), reverse=True)
+        worst[name] = ranked[0]
+        seeds.extend(unit for _, unit in ranked[:5])
+        print('%-9s worst %.3f us/char (%.2fx chat)  %r'
+              % (name, ranked[0][0] * 1e6, ranked[0][0] / baseline, ranked[0][1]))
+    found = search(parser, seeds, pieces, args.length, args.seconds, rng)
+    print('search    worst %.3f us/char (%.2fx chat)  %r  after %d units'
+          % (found[0][0] * 1e6, found[0][0] / baseline, found[0][1], len(found)))
+
+    checked = list(dict.fromkeys([('parse', unit) for _, unit in found[:args.check]] +
+                                 [('parse', unit) for _, unit in worst.values()] +
+                                 [('parse_markup', unit) for unit in MARKUP_UNITS]))
+    results = []
+    ok = True
+    for method, unit in checked:
+        lengths, costs, exponent = growth(parser, unit, args.length, args.doublings,
+                                          args.rounds, method)
+        spread = costs[-1] / costs[0]
+        ratio = max(costs) / baselines[method]
+        passed = exponent <= args.max_exponent and spread <= args.max_growth and (
+            args.max_ratio is None or ratio <= args.max_ratio)
+        ok = ok and passed
+        results.append(dict(method=method, unit=unit, lengths=lengths, seconds_per_char=costs,
+                            exponent=exponent, growth=spread, ratio=ratio,
+                            passed=passed))
+        print('%-4s exponent %.3f  growth %.2fx  %.2fx chat  %s  %s%r'
+              % ('ok' if passed else 'FAIL', exponent, spread, ratio,
+                 ' '.join('%.2f' % (cost * 1e6) for cost in costs),
+                 'markup ' if method == 'parse_markup' else '', unit))
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(dict(baseline=baseline, results=results,
+                           families=dict((name, unit) for name, (_, unit) in worst.items())),
+                      out, ensure_ascii=False, indent=1)
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""Measures parser memory churn and checks that memory stays flat over
+long runs
+
+The alloc mode parses each corpus mix under tracemalloc and reports the
+peak traced bytes of a call and the bytes retained after all calls, each
+per input character, blocks left allocated per input character, the lines
+holding most of them, and garbage collections
+and time spent collecting per million characters. tracemalloc only sees
+memory that is live, so short lived allocations, such as the match dicts
+made per character, show up in peak bytes rather than as a count.
+
+The soak mode calls parse and parse_text over the corpus for --seconds,
+sampling resident memory, and exits with status 1 if it grew by more than
+--tolerance MiB after warming up. Fewer than --min-samples samples after
+warming up are too few to tell, and exit with status 2.
+
+Usage:
+
+::
+python benchmarks/bench_memory.py alloc --chars 50000
+python benchmarks/bench_memory.py soak --seconds 7200 --interval 60
+
+"""
+import argparse
+import gc
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from avrolib import AvroParser
+from corpus import MIXES, make_mix
+
+
+class GCWatch():
+    """Counts collections per generation and time spent in them"""
+
+    def __init__(self):
+        self.collections = [0, 0, 0]
+        self.seconds = 0.
+        self._start = None
+
+    def __enter__(self):
+        gc.callbacks.append(self._callback)
+        return self
+
+    def __exit__(self, *exc):
+        gc.callbacks.remove(self._callback)
+
+    def _callback(self, phase, info):
+        if phase == 'start':
+            self._start = time.perf_counter()
+        elif self._start is not None:
+            self.seconds += time.perf_counter() - self._start
+            self.collections[info['generation']] += 1
+            self._start = None
+
+
+def alloc(parser, name, texts, top):
+    """Returns allocation and collection figures for parsing texts"""
+    chars = sum(len(text) for text in texts)
+    # Warm lazily built tables so they are not counted against the corpus
+    for text in texts[:10]:
+        parser.parse(text)
+    gc.collect()
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__),
+              tracemalloc.Filter(False, __file__)]
+    peaks = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot().filter_traces(ignore)
+    with GCWatch() as watch:
+        for text in texts:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            parser.parse(text)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    after = tracemalloc.take_snapshot().filter_traces(ignore)
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'lineno')
+    peak = sum(peaks) / len(peaks) / (chars / len(texts))
+    retained = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    million = 1e6 / chars
+    print('%-8s %8d chars  peak %7.1f B/char  retained %6.3f B/char  '
+          '%6.4f blocks/char' % (name, chars, peak, retained / chars,
+                                 blocks / chars))
+    print('         gc per Mchar: %s collections by generation, %.4fs'
+          % ([round(count * million, 1) for count in watch.collections],
+             watch.seconds * million))
+    for stat in stats[:top]:
+        if stat.size_diff > 0:
+            print('         %+8d B %+6d blocks  %s'
+                  % (stat.size_diff, stat.count_diff, stat.traceback))
+
+
+def rss():
+    """Returns resident memory in bytes"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        # Peak rather than current outside Linux, which still shows growth
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def soak(args):
+    """Parses until args.seconds pass and returns whether memory stayed
+    flat, or None if too few samples were taken after warming up to tell"""
+    rng = random.Random(args.seed)
+    texts = [text for name in MIXES if name != 'long'
+             for text in make_mix(name, rng, args.chars)]
+    parser = AvroParser()
+    samples = []
+    calls = chars = 0
+    start = last = time.monotonic()
+    while time.monotonic() - start < args.seconds:
+        for text in texts:
+            parser.parse(text)
+            calls += 1
+            chars += len(text)
+            if calls % args.parse_text_every == 0:
+                AvroParser.parse_text(text)
+        now = time.monotonic()
+        if now - last >= args.interval or not samples:
+            last = now
+            samples.append((now - start, rss()))
+            print('%8.0fs %10d calls %8.1f MiB' % (now - start, calls,
+                                                   samples[-1][1] / 2 ** 20))
+    settled = [size for at, size in samples if at >= args.seconds * args.warmup]
+    if len(settled) < args.min_samples:
+        print('inconclusive: %d samples after warming up, %d needed; run longer '
+              'or sample more often' % (len(settled), args.min_samples))
+        return None
+    baseline = min(settled[:max(1, len(settled) // 4)])
+    final = statistics.median(settled[-max(1, len(settled) // 4):])
+    growth = (final - baseline) / 2 ** 20
+    print('%d calls, %d chars; RSS %+.2f MiB after warming up (tolerance %.2f)'
+          % (calls, chars, growth, args.tolerance))
+    return growth <= args.tolerance
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    sub = ap.add_subparsers(dest='mode', required=True)
+    a = sub.add_parser('alloc', help='allocation and collection figures per mix')
+    a.add_argument('--chars', type=int, default=50000)
+    a.add_argument('--top', type=int, default=3,
+                   help='lines holding the most retained memory to show')
+    s = sub.add_parser('soak', help='check that memory stays flat')
+    s.add_argument('--seconds', type=float, default=600)
+    s.add_argument('--interval', type=float, default=10,
+                   help='seconds between memory samples')
+    s.add_argument('--warmup', type=float, default=0.2,
+                   help='fraction of the run ignored while caches fill')
+    s.add_argument('--tolerance', type=float, default=4,
+                   help='MiB of growth allowed after warming up')
+    s.add_argument('--min-samples', type=int, default=8,
+                   help='samples needed after warming up to pass or fail')
+    s.add_argument('--parse-text-every', type=int, default=100,
+                   help='also call parse_text once per this many parses')
+    s.add_argument('--chars', type=int, default=20000)
+    for p in (a, s):
+        p.add_argument('--seed', type=int, default=0)
+    args = ap.parse_args()
+
+    if args.mode == 'alloc':
+        parser = AvroParser()
+        rng = random.Random(args.seed)
+        for name in MIXES:
+            alloc(parser, name, make_mix(name, rng, args.chars), args.top)
+        gc.collect()
+        tracemalloc.start()
+        AvroParser.parse_text('ami')
+        print('parse_text peak %.1f KiB per call, for building and discarding '
+              'a parser' % (tracemalloc.get_traced_memory()[1] / 1024))
+        tracemalloc.stop()
+    else:
+        flat = soak(args)
+        if flat is None:
+            sys.exit(2)
+        if not flat:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Times backfilling a transliterated column in SQLite, with avro() running
+inside the database against fetching, parsing and writing rows back
+
+Usage:
+
+::
+python benchmarks/bench_sqlite.py --rows 2000000
+
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from avrolib import AvroParser, register_sqlite_function
+from corpus import make_vocabulary
+
+
+def make_table(db, rows, distinct, seed):
+    """Fills table words with rows roman values drawn from distinct words"""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(distinct, seed)
+    db.execute('DROP TABLE IF EXISTS words')
+    db.execute('CREATE TABLE words (id INTEGER PRIMARY KEY, roman TEXT, bn TEXT)')
+    db.executemany('INSERT INTO words (roman) VALUES (?)',
+                   ((rng.choice(vocabulary),) for _ in range(rows)))
+    db.commit()
+
+
+def in_database(db, parser):
+    avro = register_sqlite_function(db, parser=parser)
+    db.execute('UPDATE words SET bn = avro(roman)')
+    db.commit()
+    return avro.cache_info()
+
+
+def round_trip(db, parser):
+    rows = db.execute('SELECT id, roman FROM words').fetchall()
+    db.executemany('UPDATE words SET bn = ? WHERE id = ?',
+                   [(parser.parse(roman), id) for id, roman in rows])
+    db.commit()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--rows', type=int, default=2000000)
+    ap.add_argument('--distinct', type=int, default=20000)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--round-trip', action='store_true',
+                    help='also time fetching rows and parsing each one in Python')
+    args = ap.parse_args()
+
+    parser = AvroParser()
+    with tempfile.TemporaryDirectory() as tmp:
+        db = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+        make_table(db, args.rows, args.distinct, args.seed)
+        start = time.perf_counter()
+        info = in_database(db, parser)
+        elapsed = time.perf_counter() - start
+        print('UPDATE ... SET bn = avro(roman): %.2fs, %.0f rows/s, %s'
+              % (elapsed, args.rows / elapsed, info))
+        if args.round_trip:
+            start = time.perf_counter()
+            round_trip(db, parser)
+            elapsed = time.perf_counter() - start
+            print('fetch, parse and write back:     %.2fs, %.0f rows/s'
+                  % (elapsed, args.rows / elapsed))
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
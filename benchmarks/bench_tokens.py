@@ -0,0 +1,85 @@
+"""Compares parse followed by a separate tokenising pass with the word
+tokens that parse emits from the same pass
+
+Tokenising the output alone only finds output offsets. Finding source
+offsets as well takes the spans of the parse and a lookup in them for each
+token, which is what the fused pass saves. The best of --repeat runs of
+each is printed.
+
+Usage:
+
+::
+python benchmarks/bench_tokens.py --chars 200000
+
+"""
+import argparse
+import os
+import re
+from bisect import bisect_right
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from avrolib import AvroParser
+from corpus import make_text
+
+
+WORD = re.compile(r'[^\s.,?!\u0964]+')
+
+
+def two_passes(parser, text):
+    """Parses text, then tokenises the output on its own, finding output
+    offsets only"""
+    output = parser.parse(text)
+    return output, [m.span() for m in WORD.finditer(output)]
+
+
+def two_passes_aligned(parser, text):
+    """Parses text with its spans, then tokenises the output and maps each
+    token back to the source through the spans"""
+    output, spans = parser.parse(text, with_spans=True)
+    sources, outputs = spans.source_offsets, spans.output_offsets
+    tokens = []
+    for match in WORD.finditer(output):
+        out_start, out_end = match.span()
+        first = bisect_right(outputs, out_start) - 1
+        last = bisect_right(outputs, out_end - 1)
+        tokens.append((sources[first], sources[last], out_start, out_end))
+    return output, tokens
+
+
+def fused(parser, text):
+    """Parses text and collects word tokens in the same pass"""
+    return parser.parse(text, with_tokens=True)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--chars', type=int, default=200000)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args()
+
+    parser = AvroParser()
+    text = make_text(args.chars, args.seed)
+    runs = (('parse + tokenise', two_passes),
+            ('+ source offsets', two_passes_aligned),
+            ('fused', fused))
+    best = dict((name, float('inf')) for name, _ in runs)
+    counts = {}
+    # Runs are interleaved so that the machine slowing down or speeding up
+    # in between falls on all of them alike
+    for _ in range(args.repeat):
+        for name, run in runs:
+            start = time.perf_counter()
+            _, tokens = run(parser, text)
+            best[name] = min(best[name], time.perf_counter() - start)
+            counts[name] = len(tokens)
+    for name, _ in runs:
+        print('%-18s %8.3fs %10.0f chars/s %8d tokens'
+              % (name, best[name], len(text) / best[name], counts[name]))
+
+
+if __name__ == '__main__':
+    main()
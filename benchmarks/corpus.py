@@ -0,0 +1,147 @@
+"""Seeded synthetic corpora of Banglish text for benchmarks
+
+Every generator takes a random.Random, so the same seed always gives the
+same corpus. MIXES names the standard mixes used by run.py.
+
+Usage:
+
+::
+import random
+from corpus import make_mix
+texts = make_mix('chat', random.Random(0), chars=20000)
+
+"""
+import random
+
+# Common words as typed in Banglish
+WORDS = ['ami', 'tumi', 'apni', 'se', 'amra', 'tomra', 'banglay', 'bangla',
+         'gan', 'gai', 'kemon', 'acho', 'achen', 'bhalo', 'khub', 'amar',
+         'tomar', 'sOnar', 'ekhon', 'kotha', 'bolo', 'bolchi', 'rasta', 'ghor',
+         'bari', 'jabo', 'jacchi', 'korbo', 'korechi', 'dekha', 'hobe', 'na',
+         'haa', 'kintu', 'ebong', 'jodi', 'tahole', 'shob', 'kichu', 'onek',
+         'choto', 'boRo', 'notun', 'purano', 'shokal', 'raat', 'din', 'bochor',
+         'bhai', 'bondhu', 'ma', 'baba', 'shikkha', 'prithibi', 'rritu', 'kSoma',
+         'oikko', 'OUShodh', 'dhonnobad', 'shubho', 'janmodin', 'Thik', 'aChe']
+
+# Syllables for words outside the common list
+SYLLABLES = ['a', 'i', 'u', 'e', 'o', 'O', 'I', 'U', 'ka', 'kh', 'ga', 'gh',
+             'ch', 'cha', 'ja', 'jh', 'Ta', 'Th', 'Da', 'Dh', 'Na', 'ta', 'th',
+             'da', 'dh', 'na', 'pa', 'ph', 'ba', 'bh', 'ma', 'za', 'ra', 'la',
+             'sha', 'Sa', 'sa', 'ha', 'Ra', 'y', 'w', 'rri', 'ng', 'ksh', 'ngk']
+
+# Words already in Bengali script, for mixed-script text
+BENGALI = ['আমি', 'তুমি', 'বাংলা', 'গান', 'ভালো', 'খুব', 'কেমন', 'আছো',
+           'ধন্যবাদ', 'শুভ', 'সকাল', 'রাত', 'বন্ধু', 'পৃথিবী', '।']
+
+# English words that show up in Banglish chat
+ENGLISH = ['ok', 'please', 'thanks', 'meeting', 'office', 'phone', 'online',
+           'LOL', 'btw', 'update']
+
+EMOJI = ['\U0001F600', '\U0001F602', '\U0001F44D', '❤️', '\U0001F64F']
+
+
+def word(rng):
+    """Returns a common word most of the time, else a made up one"""
+    if rng.random() < 0.8:
+        return rng.choice(WORDS)
+    return ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4)))
+
+
+def sentence(rng, words=None, bengali=0.0, english=0.0, digits=0.0):
+    """Returns a sentence with the given shares of other kinds of tokens"""
+    tokens = []
+    for _ in range(words or rng.randint(3, 14)):
+        roll = rng.random()
+        if roll < bengali:
+            tokens.append(rng.choice(BENGALI))
+        elif roll < bengali + english:
+            tokens.append(rng.choice(ENGLISH))
+        elif roll < bengali + english + digits:
+            tokens.append(number(rng))
+        else:
+            tokens.append(word(rng))
+    return ' '.join(tokens) + rng.choice(['.', '.', '?', '!', ','])
+
+
+def number(rng):
+    """Returns a count, amount, date, time or phone number"""
+    kind = rng.randint(0, 4)
+    if kind == 0:
+        return str(rng.randint(0, 999))
+    if kind == 1:
+        return '$%d.%02d' % (rng.randint(1, 9999), rng.randint(0, 99))
+    if kind == 2:
+        return '%02d/%02d/%d' % (rng.randint(1, 28), rng.randint(1, 12),
+                                 rng.randint(1950, 2030))
+    if kind == 3:
+        return '%d:%02d' % (rng.randint(0, 23), rng.randint(0, 59))
+    return '01%d-%07d' % (rng.randint(3, 9), rng.randint(0, 9999999))
+
+
+def roman(rng):
+    """A line of pure Banglish"""
+    return sentence(rng)
+
+
+def mixed(rng):
+    """A line mixing Banglish with Bengali script and English"""
+    return sentence(rng, bengali=0.3, english=0.1)
+
+
+def digits(rng):
+    """A line heavy with numbers, dates and amounts"""
+    return sentence(rng, digits=0.4)
+
+
+def long(rng, chars=20000):
+    """A document of paragraphs of about chars characters"""
+    paragraphs = []
+    size = 0
+    while size < chars:
+        paragraph = ' '.join(sentence(rng, bengali=0.05, digits=0.05)
+                             for _ in range(rng.randint(3, 8)))
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+    return '\n\n'.join(paragraphs)
+
+
+def chat(rng):
+    """A short chat message"""
+    text = sentence(rng, words=rng.randint(1, 6), english=0.15)
+    if rng.random() < 0.3:
+        text += ' ' + rng.choice(EMOJI)
+    return text
+
+
+MIXES = {
+    'roman': roman,
+    'mixed': mixed,
+    'digits': digits,
+    'long': long,
+    'chat': chat,
+}
+
+
+def make_mix(name, rng, chars=20000):
+    """Returns a list of texts of mix name, about chars characters in all"""
+    if name == 'long':
+        return [long(rng, chars)]
+    texts = []
+    size = 0
+    make = MIXES[name]
+    while size < chars:
+        texts.append(make(rng))
+        size += len(texts[-1])
+    return texts
+
+
+def make_text(chars, seed=0):
+    """Returns about chars characters of Banglish sentences as one text"""
+    rng = random.Random(seed)
+    return ' '.join(make_mix('roman', rng, chars))
+
+
+def make_vocabulary(size, seed=0):
+    """Returns size words, common and made up, allowing repeats"""
+    rng = random.Random(seed)
+    return [word(rng) for _ in range(size)]
@@ -0,0 +1,392 @@
+"""Differential check of every parsing engine against the frozen reference
+
+Each engine must give exactly the output of ReferenceAvroParser.parse on:
+
+- golden: the inputs and outputs stored in golden.json
+- exhaustive: every string up to --length characters over an alphabet of
+  the characters the ruleset uses, plus a space and a hyphen
+- random: seeded random strings weighted towards pattern characters, with
+  some non-ASCII, mixed-case and whitespace characters thrown in
+- rulesets: --rulesets seeded random rulesets loaded with
+  AvroParser.from_ruleset, each checked on random strings against a
+  reference built from the same ruleset
+- overlays: --rulesets seeded random deltas overlaid on the default or a
+  random ruleset, each checked against a reference built from the patterns
+  the overlay should end up with
+
+Mismatching inputs are shrunk to a smallest failing input before being
+reported, and in the last two suites are prefixed with the number of the
+ruleset they failed on. Each engine's speed is reported relative to the
+reference. The exit status is 1 if any engine mismatched.
+
+Usage:
+
+::
+python benchmarks/equivalence.py
+python benchmarks/equivalence.py --length 3 --random 20000 --output report.json
+python benchmarks/equivalence.py --rulesets 500 --engines parse spans document
+python benchmarks/equivalence.py --update-golden
+
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from avrolib import (AvroDocument, AvroParser, AvroPipeline, AvroSession)
+from corpus import MIXES, make_mix
+from reference import ReferenceAvroParser
+
+GOLDEN = os.path.join(HERE, 'golden.json')
+
+# Characters beyond the ruleset that engines treat specially
+EXTRA = ['ব', 'া', '।', '‌', '😀', 'É', 'ß', 'İ', 'K', '\t', '\n']
+
+# Letters random rulesets are made of, and pieces of their replacements
+LETTERS = 'abcdeghiklmnorstuwyz'
+OUTPUTS = ['অ', 'আ', 'ই', 'ক', 'খ', 'গ', 'ং', '্', 'া', 'ি', 'ু', '\u200c', '-', 'x']
+
+
+def typed(parser, text):
+    """Types text one character at a time into a session, applying edits"""
+    session = AvroSession(parser)
+    output = ''
+    for char in text:
+        edit = session.append(char)
+        output = output[:len(output) - edit.delete] + edit.insert
+    return output
+
+
+def edited(parser, text):
+    """Builds a document from the end of text, then inserts the rest"""
+    half = len(text) // 2
+    document = AvroDocument(parser, text[half:])
+    output = document.output
+    edit = document.edit(0, 0, text[:half])
+    return output[:edit.start] + edit.insert + output[edit.start + edit.delete:]
+
+
+def engines(parser):
+    """Returns engines as functions from a list of texts to their outputs"""
+    pipeline = AvroPipeline(AvroPipeline.normalise(parser), AvroPipeline.segment(),
+                            AvroPipeline.cache(), AvroPipeline.transliterate(parser))
+    found = {
+        'parse': lambda texts: [parser.parse(text) for text in texts],
+        'parse_text': lambda texts: [AvroParser.parse_text(text) for text in texts],
+        'spans': lambda texts: [parser.parse(text, with_spans=True)[0]
+                                for text in texts],
+        'tokens': lambda texts: [parser.parse(text, with_tokens=True)[0]
+                                 for text in texts],
+        'markup': lambda texts: [parser.parse_markup(text, protect=())
+                                 for text in texts],
+        'bytes': lambda texts: [parser.parse_bytes(text.encode('utf-8')).decode('utf-8')
+                                for text in texts],
+        'session': lambda texts: [typed(parser, text) for text in texts],
+        'document': lambda texts: [edited(parser, text) for text in texts],
+        'pipeline': lambda texts: list(pipeline(texts)),
+    }
+    try:
+        from avrolib import AvroBatchParser
+        found['batch'] = AvroBatchParser(parser).parse_many
+    except ImportError:
+        pass
+    return found
+
+
+def random_ruleset(rng):
+    """Returns a random ruleset in the schema of init_data, with a few
+    letters split into vowels and consonants, some of them case sensitive,
+    and patterns whose rules use every scope"""
+    letters = rng.sample(LETTERS, rng.randint(3, 10))
+    split = rng.randint(1, len(letters) - 1)
+    sensitive = ''.join(char for char in letters if rng.random() < 0.3)
+    symbols = letters + [char.upper() for char in sensitive] + list('`.,')
+    return {
+        'VOWELS': ''.join(letters[:split]),
+        'CONSONANTS': ''.join(letters[split:]),
+        'CASESENSITIVES': sensitive,
+        'DIGITS': rng.choice(('', '0123456789')),
+        'PATTERNS': [random_pattern(rng, symbols, rng.random() < 0.4)
+                     for _ in range(rng.randint(1, 25))],
+    }
+
+
+def random_pattern(rng, symbols, ruled, find=None):
+    """Returns a random pattern over symbols, with rules if ruled"""
+    def text(most):
+        return ''.join(rng.choice(symbols) for _ in range(rng.randint(1, most)))
+
+    def output():
+        return ''.join(rng.choice(OUTPUTS) for _ in range(rng.randint(0, 3)))
+    pattern = {'find': find or text(4), 'replace': output()}
+    if ruled:
+        # The reference cannot parse with an empty list of rules
+        pattern['rules'] = []
+        for _ in range(rng.randint(1, 3)):
+            matches = []
+            for _ in range(rng.randint(1, 3)):
+                scope = rng.choice(AvroParser.SCOPES)
+                match = {'type': rng.choice(('prefix', 'suffix')),
+                         'scope': '!' * rng.randint(0, 1) + scope}
+                if scope == 'exact':
+                    match['value'] = text(3)
+                matches.append(match)
+            pattern['rules'].append({'matches': matches, 'replace': output()})
+    return pattern
+
+
+def random_delta(rng, base):
+    """Returns a random overlay delta for the ruleset base, replacing some
+    of its patterns and adding new ones, with no find given twice"""
+    symbols = sorted(set(base['VOWELS'] + base['CONSONANTS']) |
+                     set(char for p in base['PATTERNS'] for char in p['find']))
+    finds = sorted(set(p['find'] for p in base['PATTERNS']))
+    chosen = set(rng.sample(finds, min(len(finds), rng.randint(0, 4))))
+    for _ in range(rng.randint(0, 4)):
+        chosen.add(''.join(rng.choice(symbols) for _ in range(rng.randint(1, 3))))
+    chosen = sorted(chosen) or [rng.choice(finds)]
+    rng.shuffle(chosen)
+    return {'PATTERNS': [random_pattern(rng, symbols, rng.random() < 0.4, find)
+                         for find in chosen]}
+
+
+def overlaid(base, delta):
+    """Returns the ruleset an overlay of delta on base should parse with:
+    delta's new finds first, then base's patterns, each pattern with a find
+    in delta taken from delta instead"""
+    replacing = dict((p['find'], p) for p in delta['PATTERNS'])
+    finds = set(p['find'] for p in base['PATTERNS'])
+    patterns = [p for p in delta['PATTERNS'] if p['find'] not in finds]
+    patterns.extend(replacing.get(p['find'], p) for p in base['PATTERNS'])
+    return dict(base, PATTERNS=patterns)
+
+
+def alphabet(parser):
+    """Returns the characters the ruleset matches on, plus a few others"""
+    chars = set(parser.VOWELS + parser.CONSONANTS)
+    chars.update(parser.VOWELS.upper() + parser.CONSONANTS.upper())
+    for pattern in parser.PATTERNS:
+        chars.update(pattern['find'])
+    return ''.join(sorted(chars)) + ' -'
+
+
+def golden_inputs():
+    with open(GOLDEN) as golden:
+        return [(text, expected) for text, expected in json.load(golden)]
+
+
+def exhaustive_inputs(chars, length):
+    for size in range(length + 1):
+        for letters in itertools.product(chars, repeat=size):
+            yield ''.join(letters)
+
+
+def random_inputs(chars, count, seed, max_length=24):
+    rng = random.Random(seed)
+    weighted = list(chars) * 4 + EXTRA
+    for _ in range(count):
+        yield ''.join(rng.choice(weighted) for _ in range(rng.randint(0, max_length)))
+
+
+def ruleset_cases(count, seed, inputs, overlays=False):
+    """Yields a parser, its reference and inputs for each of count random
+    rulesets, or overlays of random deltas if overlays is True"""
+    rng = random.Random(seed)
+    default = AvroParser()
+    for _ in range(count):
+        if overlays:
+            if rng.random() < 0.5:
+                base, data = default, default.data
+            else:
+                data = random_ruleset(rng)
+                base = AvroParser.from_ruleset(data)
+            delta = random_delta(rng, data)
+            parser = base.overlay(delta)
+            data = overlaid(data, delta)
+        else:
+            data = random_ruleset(rng)
+            parser = AvroParser.from_ruleset(data)
+        data = dict(data, DIGITS=data.get('DIGITS', ''))
+        chars = alphabet(parser)
+        yield (parser, ReferenceAvroParser(data),
+               list(random_inputs(chars, inputs, rng.random(), max_length=16)))
+
+
+def check_rulesets(cases, names, examples):
+    """Returns the results of each engine over all cases, keyed by name,
+    with its examples prefixed by the number of their case"""
+    results = {'reference_seconds': 0.}
+    for number, (parser, reference, inputs) in enumerate(cases):
+        start = time.perf_counter()
+        expected = [reference.parse(text) for text in inputs]
+        seconds = time.perf_counter() - start
+        results['reference_seconds'] += seconds
+        for name, engine in engines(parser).items():
+            # parse_text always uses the default ruleset
+            if name == 'parse_text' or names and name not in names:
+                continue
+            total = results.setdefault(name, {'inputs': 0, 'mismatches': 0,
+                                              'examples': [], 'seconds': 0.})
+            if 'error' in total:
+                continue
+            result = check(name, engine, reference, inputs, expected, seconds,
+                           examples - len(total['examples']))
+            if 'error' in result:
+                total.clear()
+                total['error'] = '#%d %s' % (number, result['error'])
+                continue
+            total['inputs'] += result['inputs']
+            total['mismatches'] += result['mismatches']
+            total['seconds'] += result['seconds']
+            total['examples'].extend('#%d %r' % (number, example)
+                                     for example in result['examples'])
+    for name, total in results.items():
+        if isinstance(total, dict) and 'error' not in total:
+            total['speedup'] = (results['reference_seconds'] / total['seconds']
+                                if total['seconds'] else None)
+    return results
+
+
+def shrink(engine, reference, text):
+    """Returns a shortest found input on which engine and reference differ"""
+    changed = True
+    while changed:
+        changed = False
+        for index in range(len(text)):
+            candidate = text[:index] + text[index + 1:]
+            if engine([candidate])[0] != reference.parse(candidate):
+                text, changed = candidate, True
+                break
+    return text
+
+
+def check(name, engine, reference, inputs, expected, reference_seconds, examples):
+    start = time.perf_counter()
+    try:
+        outputs = engine(inputs)
+    except Exception as error:
+        return {'error': '%s: %s' % (type(error).__name__, error)}
+    seconds = time.perf_counter() - start
+    failed = [text for text, out, want in zip(inputs, outputs, expected) if out != want]
+    return {
+        'inputs': len(inputs),
+        'mismatches': len(failed),
+        'examples': [shrink(engine, reference, text) for text in failed[:max(examples, 0)]],
+        'seconds': seconds,
+        'speedup': reference_seconds / seconds if seconds else None,
+    }
+
+
+def run(args):
+    parser = AvroParser()
+    reference = ReferenceAvroParser()
+    chars = alphabet(parser)
+    suites = {
+        'golden': [text for text, _ in golden_inputs()],
+        'exhaustive': list(exhaustive_inputs(chars, args.length)),
+        'random': list(random_inputs(chars, args.random, args.seed)),
+    }
+    report = {'suites': {}}
+    found = engines(parser)
+    for suite, inputs in suites.items():
+        start = time.perf_counter()
+        expected = [reference.parse(text) for text in inputs]
+        reference_seconds = time.perf_counter() - start
+        results = {'reference_seconds': reference_seconds}
+        if suite == 'golden':
+            stored = [want for _, want in golden_inputs()]
+            results['reference_mismatches'] = sum(a != b for a, b in zip(expected, stored))
+        for name, engine in found.items():
+            if args.engines and name not in args.engines:
+                continue
+            results[name] = check(name, engine, reference, inputs, expected,
+                                  reference_seconds, args.examples)
+            print('%-10s %-10s %s' % (suite, name, summary(results[name])))
+        report['suites'][suite] = results
+    for suite in ('rulesets', 'overlays'):
+        cases = ruleset_cases(args.rulesets, args.seed, args.ruleset_inputs,
+                              overlays=suite == 'overlays')
+        results = check_rulesets(cases, args.engines, args.examples)
+        for name, result in results.items():
+            if isinstance(result, dict):
+                print('%-10s %-10s %s' % (suite, name, summary(result)))
+        report['suites'][suite] = results
+    return report
+
+
+def summary(result):
+    if 'error' in result:
+        return 'ERROR ' + result['error']
+    text = '%d/%d mismatches, %.2fx reference speed' % (
+        result['mismatches'], result['inputs'], result['speedup'] or 0)
+    if result['examples']:
+        text += ', e.g. ' + ', '.join(example if isinstance(example, str) and
+                                      example.startswith('#') else repr(example)
+                                      for example in result['examples'])
+    return text
+
+
+def failed(report):
+    for results in report['suites'].values():
+        if results.get('reference_mismatches'):
+            return True
+        for result in results.values():
+            if isinstance(result, dict) and (result.get('error') or result.get('mismatches')):
+                return True
+    return False
+
+
+def update_golden(seed):
+    """Rewrites golden.json from the corpus mixes and the reference"""
+    reference = ReferenceAvroParser()
+    rng = random.Random(seed)
+    inputs = ['', 'ami banglay gan gai', 'hZalO', 'OI`', 'rri', 'kkh`', "t``",
+              'arr', 'rZ', 'oo`', 'y', 'w', 'x', 'İstanbul', 'Kh']
+    for name in MIXES:
+        if name != 'long':
+            inputs.extend(make_mix(name, rng, 6000))
+    inputs.extend(line for line in make_mix('long', rng, 6000)[0].split('\n') if line)
+    with open(GOLDEN, 'w') as golden:
+        json.dump([[text, reference.parse(text)] for text in inputs], golden,
+                  ensure_ascii=False, indent=0)
+        golden.write('\n')
+    print('wrote %d cases to %s' % (len(inputs), GOLDEN))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--length', type=int, default=2,
+                    help='longest string in the exhaustive suite')
+    ap.add_argument('--random', type=int, default=5000,
+                    help='number of random inputs')
+    ap.add_argument('--rulesets', type=int, default=50,
+                    help='number of random rulesets, and of random overlays')
+    ap.add_argument('--ruleset-inputs', type=int, default=200,
+                    help='number of random inputs per ruleset or overlay')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--examples', type=int, default=3,
+                    help='shrunk mismatches to report per engine and suite')
+    ap.add_argument('--engines', nargs='+', help='only check these engines')
+    ap.add_argument('--output', help='write the report to this JSON file')
+    ap.add_argument('--update-golden', action='store_true',
+                    help='regenerate golden.json from the reference and exit')
+    args = ap.parse_args()
+
+    if args.update_golden:
+        update_golden(args.seed)
+        return
+    report = run(args)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent=2, ensure_ascii=False)
+    sys.exit(1 if failed(report) else 0)
+
+
+if __name__ == '__main__':
+    main()
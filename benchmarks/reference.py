@@ -0,0 +1,276 @@
+"""The parse algorithm exactly as avrolib first shipped it
+
+ReferenceAvroParser is frozen: it is the oracle that equivalence.py holds
+every other engine to, so it must not be optimised or otherwise changed.
+It only takes its ruleset from outside, so that engines can be checked on
+any ruleset.
+
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from avrolib import AvroParser
+
+
+class ReferenceAvroParser():
+    def __init__(self, data=None):
+        if data is None:
+            data = AvroParser().data
+        self.PATTERNS = data['PATTERNS']
+        self.NON_RULE_PATTERNS = [p for p in self.PATTERNS if 'rules' not in p]
+        self.RULE_PATTERNS = [p for p in self.PATTERNS if 'rules' in p]
+
+        self.VOWELS = data['VOWELS']
+        self.CONSONANTS = data['CONSONANTS']
+        self.CASESENSITIVES = data['CASESENSITIVES']
+        self.DIGITS = data['DIGITS']
+
+    def parse(self, text):
+        """Parses input text, matches and replaces using avro library
+
+        If a valid replacement is found, returns the replaced string. If
+        no replacement is found, returns the input text.
+
+        """
+        # Sanitize text case to meet phonetic comparison standards
+        fixed_text = self._fix_string_case(self._utf(text))
+        # prepare output list
+        output = []
+        # cursor end point
+        cur_end = 0
+        # iterate through input text
+        for cur, i in enumerate(fixed_text):
+            # Trap characters with unicode encoding errors
+            try:
+                i.encode('utf-8')
+            except UnicodeDecodeError:
+                uni_pass = False
+            else:
+                uni_pass = True
+            # Default value for match
+            match = {'matched': False}
+            # Check cur is greater than or equals cur_end. If cursor is in
+            # a position that has alread been processed/replaced, we don't
+            # process anything at all
+            if not uni_pass:
+                cur_end = cur + 1
+                output.append(i)
+            elif cur >= cur_end and uni_pass:
+                # Try looking in non rule self.PATTERNS with current string portion
+                match = self._match_non_rule_patterns(fixed_text, cur)
+                # Check if non rule self.PATTERNS have matched
+                if match["matched"]:
+                    output.append(match["replaced"])
+                    cur_end = cur + len(match["found"])
+                else:
+                # if non rule self.PATTERNS have not matched, try rule self.PATTERNS
+                    match = self._match_rule_patterns(fixed_text, cur)
+                    # Check if rule self.PATTERNS have matched
+                    if match["matched"]:
+                        # Update cur_end as cursor + length of match found
+                        cur_end =  cur + len(match["found"])
+                        # Process its rules
+                        replaced = self._process_rules(rules = match["rules"],
+                                                fixed_text = fixed_text,
+                                                cur = cur, cur_end = cur_end)
+                        # If any rules match, output replacement from the
+                        # rule, else output it's default top-level/default
+                        # replacement
+                        if replaced is not None:
+                            # Rule has matched
+                            output.append(replaced)
+                        else:
+                            # No rules have matched
+                            # output common match
+                            output.append(match["replaced"])
+
+                # If none matched, append present cursor value
+                if not match["matched"]:
+                    cur_end = cur + 1
+                    output.append(i)
+
+        # End looping through input text and produce output
+        return ''.join(output)
+
+    def _match_non_rule_patterns(self, fixed_text, cur=0):
+        """Matches given text at cursor position with non rule self.PATTERNS
+
+        Returns a dictionary of three elements:
+
+        - "matched" - Bool: depending on if match found
+        - "found" - string/None: Value of matched pattern's 'find' key or none
+        - "replaced": string Replaced string if match found else input string at
+        cursor
+
+        """
+        pattern = self._exact_find_in_pattern(fixed_text, cur, self.NON_RULE_PATTERNS)
+        if len(pattern) > 0:
+            return {"matched": True, "found": pattern[0]['find'],
+                    "replaced": pattern[0]['replace']}
+        else:
+            return {"matched": False, "found": None,
+                    "replaced": fixed_text[cur]}
+
+    def _match_rule_patterns(self, fixed_text, cur=0):
+        """Matches given text at cursor position with rule self.PATTERNS
+
+        Returns a dictionary of four elements:
+
+        - "matched" - Bool: depending on if match found
+        - "found" - string/None: Value of matched pattern's 'find' key or none
+        - "replaced": string Replaced string if match found else input string at
+        cursor
+        - "rules": dict/None: A dict of rules or None if no match found
+
+        """
+        pattern = self._exact_find_in_pattern(fixed_text, cur, self.RULE_PATTERNS)
+        # if len(pattern) == 1:
+        if len(pattern) > 0:
+            return {"matched": True, "found": pattern[0]['find'],
+                    "replaced": pattern[0]['replace'], "rules": pattern[0]['rules']}
+        else:
+            return {"matched": False, "found": None,
+                    "replaced": fixed_text[cur], "rules": None}
+
+    def _exact_find_in_pattern(self, fixed_text, cur = 0, PATTERNS = None):
+        """Returns pattern items that match given text, cur position and pattern"""
+        if PATTERNS is None: PATTERNS = self.PATTERNS
+        return [x for x in PATTERNS if (cur + len(x['find']) <= len(fixed_text))
+                and x['find'] == fixed_text[cur:(cur + len(x['find']))]]
+
+    def _process_rules(self, rules, fixed_text, cur = 0, cur_end = 1):
+        """Process rules matched in pattern and returns suitable replacement
+
+        If any rule's condition is satisfied, output the rules "replace",
+        else output None
+
+        """
+        replaced = ''
+        # iterate through rules
+        for rule in rules:
+            matched = False
+            # iterate through matches
+            for match in rule['matches']:
+                matched = self._process_match(match, fixed_text, cur, cur_end)
+                # Break out of loop if we dont' have a match. Here we are
+                # trusting avrodict to have listed matches sequentially
+                if not matched:
+                    break
+            # If a match is found, stop looping through rules any further
+            if matched:
+                replaced = rule['replace']
+                break
+
+        # if any match has been found return replace value
+        if matched:
+            return replaced
+        else:
+            return None
+
+    def _process_match(self, match, fixed_text, cur, cur_end):
+        """Processes a single match in rules"""
+        # Set our tools
+        # -- Initial/default value for replace
+        replace = True
+        # -- Set check cursor depending on match['type']
+        if match['type'] == 'prefix':
+            chk = cur - 1
+        else:
+            # suffix
+            chk = cur_end
+        # -- Set scope based on whether scope is negative
+        if match['scope'].startswith('!'):
+            scope = match['scope'][1:]
+            negative = True
+        else:
+            scope = match['scope']
+            negative = False
+
+        # Let the matching begin
+        # -- Punctuations
+        if scope == 'punctuation':
+            # Conditions: XORd with negative
+            if (not ((chk < 0 and match['type'] == 'prefix') or
+                    (chk >= len(fixed_text) and match['type'] == 'suffix') or
+                    self._is_punctuation(fixed_text[chk]))
+                ^ negative):
+                replace = False
+        elif scope == 'vowel':
+            if (not (((chk >= 0 and match['type'] == 'prefix') or
+                    (chk < len(fixed_text) and match['type'] == 'suffix'))
+                    and self._is_vowel(fixed_text[chk]))
+                ^ negative):
+                replace =  False
+        elif scope == 'consonant':
+            if (not (((chk >= 0 and match['type'] == 'prefix') or
+                    (chk < len(fixed_text) and match['type'] == 'suffix'))
+                    and self._is_consonant(fixed_text[chk]))
+                ^ negative):
+                replace = False
+        # -- Exacts
+        elif scope == 'exact':
+            # Prepare cursor for exact search
+            if match['type'] == 'prefix':
+                exact_start = cur - len(match['value'])
+                exact_end = cur
+            else:
+                # suffix
+                exact_start = cur_end
+                exact_end = cur_end + len(match['value'])
+            # Validate exact find.
+            if not self._is_exact(match['value'], fixed_text, exact_start,
+                                    exact_end, negative):
+                replace = False
+        # Return replace, which will be true if none of the checks above match
+        return replace
+
+    def _utf(self, text):
+        # """Shortcut funnction for encoding given text with self._utf-8"""
+        # try:
+        #     output = unicode(text, encoding='self._utf-8')
+        # except UnicodeDecodeError:
+        #     output = text
+        # except TypeError:
+        #     output = text
+        # return output
+        return text
+
+    def _is_vowel(self, char):
+        """Check if given string is a vowel"""
+        return char.lower() in self.VOWELS
+
+    def _is_consonant(self, char):
+        """Check if given string is a consonant"""
+        return char.lower() in self.CONSONANTS
+
+    def _is_punctuation(self, char):
+        """Check if given string is a punctuation"""
+        return not (char.lower() in self.VOWELS or
+                    char.lower() in self.CONSONANTS)
+
+    def _is_case_sensitive(self, char):
+        """Check if given string is case sensitive"""
+        return char.lower() in self.CASESENSITIVES
+
+    def _is_exact(self, needle, haystack, start, end, matchnot):
+        """Check exact occurrence of needle in haystack"""
+        return ((start >= 0 and end < len(haystack) and
+                haystack[start:end] == needle) ^ matchnot)
+
+    def _fix_string_case(self, text):
+        """Converts case-insensitive characters to lower case
+
+        Case-sensitive characters as defined in self.CASESENSITIVES
+        retain their case, but others are converted to their lowercase
+        equivalents. The result is a string with phonetic-compatible case
+        which will the parser will understand without confusion.
+        """
+        fixed = []
+        for char in text:
+            if self._is_case_sensitive(char):
+                fixed.append(char)
+            else:
+                fixed.append(char.lower())
+        return ''.join(fixed)
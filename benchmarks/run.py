@@ -0,0 +1,204 @@
+"""Benchmark suite for avrolib, writing machine readable results
+
+Measures, for each corpus mix, parse throughput in chars/s and p50/p99
+latency per call, the same throughput for the other engines, the cost of
+parse_text including parser construction, the import time of avrolib,
+and peak traced memory while parsing. Results are written as JSON, to
+--output or else to stdout, so that runs can be compared with --compare.
+Progress goes to stderr.
+
+Usage:
+
+::
+python benchmarks/run.py --output results.json
+python benchmarks/run.py --output new.json --compare results.json
+
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, ROOT)
+
+from avrolib import AvroParser
+from corpus import MIXES, make_mix
+
+
+def percentile(values, fraction):
+    """Returns the value at fraction of the way through sorted values"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def engines(parser):
+    """Returns the engines to time, as functions over a list of texts"""
+    found = {
+        'parse': lambda texts: [parser.parse(text) for text in texts],
+        'parse_bytes': lambda texts: [parser.parse_bytes(text.encode('utf-8'))
+                                      for text in texts],
+    }
+    try:
+        from avrolib import AvroBatchParser
+        batch = AvroBatchParser(parser)
+        found['batch'] = batch.parse_many
+    except ImportError:
+        pass
+    return found
+
+
+def bench_mix(parser, texts, repeat):
+    """Returns throughput, latency and memory figures for texts"""
+    chars = sum(len(text) for text in texts)
+    latencies = []
+    for _ in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            parser.parse(text)
+            latencies.append(time.perf_counter() - start)
+    result = {
+        'texts': len(texts),
+        'chars': chars,
+        'parse_p50_seconds': percentile(latencies, 0.50),
+        'parse_p99_seconds': percentile(latencies, 0.99),
+        'engines': {},
+    }
+    for name, run in engines(parser).items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run(texts)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        result['engines'][name] = {'seconds': best, 'chars_per_second': chars / best}
+    tracemalloc.start()
+    for text in texts:
+        parser.parse(text)
+    result['parse_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result
+
+
+def bench_parse_text(texts, repeat):
+    """Returns the cost of parse_text, which builds a parser per call"""
+    latencies = []
+    for _ in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            AvroParser.parse_text(text)
+            latencies.append(time.perf_counter() - start)
+    return {'calls': len(latencies),
+            'p50_seconds': percentile(latencies, 0.50),
+            'p99_seconds': percentile(latencies, 0.99)}
+
+
+def bench_construction(repeat):
+    """Returns the time taken to build an AvroParser"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        AvroParser()
+        times.append(time.perf_counter() - start)
+    return {'median_seconds': statistics.median(times)}
+
+
+def bench_import(repeat):
+    """Returns the time a fresh interpreter takes to import avrolib"""
+    code = ('import sys, time; sys.path.insert(0, %r); start = time.perf_counter(); '
+            'import avrolib; print(time.perf_counter() - start)' % ROOT)
+    times = [float(subprocess.check_output([sys.executable, '-c', code]))
+             for _ in range(repeat)]
+    return {'median_seconds': statistics.median(times)}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    parser = AvroParser()
+    results = {
+        'meta': {
+            'seed': args.seed,
+            'chars': args.chars,
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'platform': platform.platform(),
+            'revision': git_revision(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'mixes': {},
+    }
+    for name in args.mixes:
+        texts = make_mix(name, random.Random(args.seed), args.chars)
+        results['mixes'][name] = bench_mix(parser, texts, args.repeat)
+        print('%-8s %s' % (name, ', '.join(
+            '%s %.0f chars/s' % (engine, figures['chars_per_second'])
+            for engine, figures in results['mixes'][name]['engines'].items())),
+              file=sys.stderr)
+    chat = make_mix('chat', random.Random(args.seed), 2000)
+    results['parse_text'] = bench_parse_text(chat, 1)
+    results['construction'] = bench_construction(20)
+    results['import'] = bench_import(5)
+    return results
+
+
+def flatten(results, prefix=''):
+    """Yields (dotted name, value) for each number in results"""
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        elif isinstance(value, (int, float)) and key not in ('seed', 'chars', 'repeat'):
+            yield prefix + key, value
+
+
+def compare(new, old, out=sys.stdout):
+    """Prints each figure of new next to old and their ratio to out"""
+    before = dict(flatten(old))
+    for name, value in flatten(new):
+        if name in before and before[name]:
+            print('%-50s %14.6g %14.6g %7.2fx' % (name, before[name], value,
+                                                value / before[name]), file=out)
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    ap.add_argument('--output', help='write results to this JSON file')
+    ap.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--chars', type=int, default=20000,
+                    help='characters of text in each mix')
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--mixes', nargs='+', default=list(MIXES), choices=list(MIXES))
+    args = ap.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.compare:
+        # Kept off stdout when the results themselves are written there
+        with open(args.compare) as old:
+            compare(results, json.load(old), sys.stdout if args.output else sys.stderr)
+
+
+if __name__ == '__main__':
+    main()